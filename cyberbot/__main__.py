@@ -27,6 +27,8 @@ def setup_cli():
     cli.add_argument("-c", "--config",
                      help="path to the configuration file")
     cli.add_argument("-v", action="store_true", help="Enable verbose output")
+    cli.add_argument("--startup-report", metavar="FILE",
+                     help="write the wall times of the startup phases as json to FILE")
     return cli
 
 
@@ -41,7 +43,7 @@ async def main():
     config.sections()
     config.read(args.config)
 
-    async with MatrixBot(config) as bot:
+    async with MatrixBot(config, startup_report=args.startup_report) as bot:
         await bot.start()
 
 
@@ -0,0 +1,115 @@
+from collections import defaultdict
+from itertools import count
+
+
+class DispatchContext:
+    """
+    Everything belonging to the dispatch of a single event. It is passed
+    along instead of being stored on the plugins, so several events can be
+    handled at the same time.
+    matches maps plugin -> [(handler, match), ...]
+    """
+
+    def __init__(self, event, matches):
+        self.event = event
+        self.matches = matches
+
+
+class CommandRouter:
+    """
+    Routes text events of a room to the handlers of its plugins.
+
+    CommandHandlers are indexed by their command word, so a message only
+    has to be tested against the handlers of the command it starts with.
+    Plain RegexHandlers can't be indexed and are still tested one by one.
+    Messages not starting with '!' are dropped right away, as long as no
+    plain RegexHandler is registered.
+    """
+
+    def __init__(self):
+        # command word -> [(seq, plugin, handler)]
+        self.commands = defaultdict(list)
+        # [(seq, plugin, handler)]
+        self.regex_handlers = []
+        # command word -> [plugin] of plugins not activated yet
+        self.lazy_commands = defaultdict(list)
+        # keeps the registration order of handlers of the same plugin
+        self.seq = count()
+
+    def add_handler(self, plugin, handler):
+        entry = (next(self.seq), plugin, handler)
+        command = getattr(handler, "command", None)
+        if command is not None:
+            self.commands[command].append(entry)
+        else:
+            self.regex_handlers.append(entry)
+
+    def add_lazy_plugin(self, plugin):
+        for command in plugin.lazy_commands:
+            self.lazy_commands[command].append(plugin)
+
+    def remove_lazy_plugin(self, plugin):
+        for command in plugin.lazy_commands:
+            if command in self.lazy_commands:
+                plugins = [p for p in self.lazy_commands[command] if p is not plugin]
+                if plugins:
+                    self.lazy_commands[command] = plugins
+                else:
+                    del self.lazy_commands[command]
+
+    def remove_plugin(self, plugin):
+        self.remove_lazy_plugin(plugin)
+        for handler in plugin.handlers:
+            command = getattr(handler, "command", None)
+            if command is not None and command in self.commands:
+                entries = [e for e in self.commands[command] if e[1] is not plugin]
+                if entries:
+                    self.commands[command] = entries
+                else:
+                    del self.commands[command]
+        self.regex_handlers = [e for e in self.regex_handlers if e[1] is not plugin]
+
+    @staticmethod
+    def command_word(body):
+        if not body.startswith("!"):
+            return None
+        parts = body[1:].split(None, 1)
+        return parts[0] if parts else None
+
+    def lazy_plugins(self, event):
+        """returns the plugins that have to be activated to handle the event"""
+        body = event.source.get('content', {}).get('body')
+        if not isinstance(body, str):
+            return []
+        return list(self.lazy_commands.get(self.command_word(body), []))
+
+    def candidates(self, event):
+        """
+        returns a dict plugin -> [handler, ...] of all handlers that may
+        match the event, in the order they were registered
+        """
+        body = event.source.get('content', {}).get('body')
+        if not isinstance(body, str):
+            return {}
+        word = self.command_word(body)
+        if word is None and not self.regex_handlers:
+            return {}
+
+        entries = self.commands.get(word, []) + self.regex_handlers
+        result = {}
+        for (seq, plugin, handler) in sorted(entries, key=lambda e: e[0]):
+            result.setdefault(plugin, []).append(handler)
+        return result
+
+    def route(self, event, room):
+        """
+        tests the candidate handlers against the event and returns a
+        DispatchContext with the matching handlers and their match objects
+        """
+        matches = {}
+        for (plugin, handlers) in self.candidates(event).items():
+            for handler in handlers:
+                match = handler.test_callback(room, event)
+                if match:
+                    matches.setdefault(plugin, []).append((handler, match))
+        return DispatchContext(event, matches)
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+# upper bounds of the latency histogram buckets (seconds), slower ones are counted as "inf"
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+
+
+class DBExecutor:
+    """
+    Runs all accesses to the sqlite connection on a dedicated thread, so a
+    slow disk or query doesn't block the event loop. The single thread
+    serializes them, thus the connection needs no locking and jobs see the
+    results of all jobs submitted before them.
+
+    The latency of every job (including the time waiting for the thread) is
+    recorded in a histogram per operation name.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        # op -> counts per bucket of LATENCY_BUCKETS + one for slower jobs
+        self.histograms = {}
+        # op -> summed up latency
+        self.total_times = {}
+
+    def submit(self, op, f, *args):
+        """runs f(conn, *args) on the database thread and returns an asyncio future"""
+        start = time.monotonic()
+        future = asyncio.wrap_future(self.executor.submit(f, self.conn, *args))
+        future.add_done_callback(lambda _: self.record(op, time.monotonic() - start))
+        return future
+
+    async def run(self, op, f, *args):
+        return await self.submit(op, f, *args)
+
+    async def fetchall(self, op, sql, params=()):
+        return await self.run(op, lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, op, sql, params=()):
+        """executes a writing statement and commits it"""
+        def execute(conn):
+            conn.execute(sql, params)
+            conn.commit()
+        await self.run(op, execute)
+
+    async def executemany(self, op, sql, seq_of_params):
+        def executemany(conn):
+            conn.executemany(sql, seq_of_params)
+            conn.commit()
+        await self.run(op, executemany)
+
+    def record(self, op, seconds):
+        if op not in self.histograms:
+            self.histograms[op] = [0] * (len(LATENCY_BUCKETS) + 1)
+            self.total_times[op] = 0
+        i = 0
+        while i < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[i]:
+            i += 1
+        self.histograms[op][i] += 1
+        self.total_times[op] += seconds
+
+    def get_stats(self):
+        """Returns count, mean latency and the latency histogram by operation"""
+        stats = {}
+        for (op, counts) in self.histograms.items():
+            count = sum(counts)
+            stats[op] = {
+                "count": count,
+                "mean": self.total_times[op] / count,
+                "histogram": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["inf"], counts)),
+            }
+        return stats
+
+    def close(self):
+        """waits for the submitted jobs and stops the thread"""
+        self.executor.shutdown(wait=True)
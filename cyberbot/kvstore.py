@@ -0,0 +1,565 @@
+import asyncio
+import contextlib
+import logging
+import sqlite3
+import sys
+import time
+
+from collections import OrderedDict
+
+# marks a pending removal in KVStore.pending
+DELETED = object()
+# returned by pending_value for keys without pending writes
+MISSING = object()
+# keys per statement of get_many, below sqlite's limit of host parameters
+MAX_KEYS_PER_STATEMENT = 500
+# rows per query of scan
+SCAN_PAGE_SIZE = 100
+# the key-value tables, all of them have the columns key, value and expires
+KV_TABLES = ["plugin_data", "room_data", "room_plugin_data"]
+# expired rows deleted per database job of sweep
+SWEEP_BATCH_SIZE = 500
+# free pages returned to the file system per database job of sweep
+VACUUM_PAGES = 1000
+
+
+def expiry(ttl):
+    """returns the time an entry set now with a ttl in seconds expires, None for never"""
+    return None if ttl is None else time.time() + ttl
+
+
+def check_key(key):
+    check_entry(key, None)
+
+
+def check_entry(key, value):
+    """
+    raises a TypeError or ValueError for keys and values sqlite can't store,
+    so the caller sees the error instead of the batch they would be written in
+    """
+    for (name, obj, types, allowed) in [
+            # the key columns are text, other keys would read back as strings
+            ("key", key, (str,), "str"),
+            ("value", value, (str, int, float, type(None)), "str, int, float or None")]:
+        if not isinstance(obj, types):
+            raise TypeError(f"key-value store {name}s must be {allowed}, not {type(obj).__name__}")
+        if isinstance(obj, int) and not -2**63 <= obj < 2**63:
+            raise TypeError(f"key-value store {name} {obj} doesn't fit in 64 bits")
+        if isinstance(obj, str):
+            try:
+                obj.encode("utf-8")
+            except UnicodeEncodeError as e:
+                raise ValueError(f"key-value store {name} is not valid unicode: {e}")
+
+
+def live(entry, now):
+    """returns the value of a pending (value, expires) entry, DELETED if it is removed or expired"""
+    (value, expires) = entry
+    if expires is not None and expires <= now:
+        return DELETED
+    return value
+
+
+def estimate_size(obj):
+    """rough number of bytes obj and the strings in it use"""
+    if isinstance(obj, (tuple, list)):
+        return sys.getsizeof(obj) + sum(estimate_size(o) for o in obj)
+    return sys.getsizeof(obj)
+
+
+class LRUCache:
+    """
+    Keeps the most recently used entries up to max_bytes of (estimated)
+    memory, the least recently used ones are evicted first.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # key -> (value, size), least recently used first
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, value):
+        self.pop(key)
+        size = estimate_size(key) + estimate_size(value)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            (k, (v, s)) = self.entries.popitem(last=False)
+            self.bytes -= s
+
+    def pop(self, key):
+        if key in self.entries:
+            (value, size) = self.entries.pop(key)
+            self.bytes -= size
+
+
+class KVStore:
+    """
+    Write-behind layer for the key-value tables of the plugins.
+
+    Writes are collected in memory and committed together in one
+    transaction (a group commit), flush_interval seconds after the first
+    pending write or as soon as flush_size writes are pending. Writes to the
+    same key in between are coalesced. Reads look at the pending writes
+    first, so they always see the latest value.
+
+    All database accesses go through the DBExecutor db. As it runs them in
+    order, a read submitted after a flush sees the flushed writes.
+
+    Committed values and key lists are cached in an LRUCache of cache_size
+    bytes (0 disables it). Writes invalidate the cached entries of their key
+    and the key list of their scope.
+
+    Entries can expire, expired ones are hidden from all reads until sweep
+    deletes them.
+
+    A scope is a table and the values of its id columns, e.g.
+    ("room_plugin_data", (("roomid", room_id), ("pluginname", pluginname))).
+    The column names are never user input.
+    """
+
+    def __init__(self, db, flush_interval, flush_size, cache_size):
+        self.db = db
+        # ("keys", table, ids) -> ([key], first expiry) or
+        # ("value", table, ids, key) -> (value, expiry)
+        self.cache = LRUCache(cache_size)
+        # (table, ids) -> number of writes, a read only fills the cache
+        # if there was no write to its scope while it was running
+        self.versions = {}
+        # table -> number of reads answered from the cache or not
+        self.hits = {}
+        self.misses = {}
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        # (table, ids, key) -> (value or DELETED, expires)
+        self.pending = {}
+        # batches of pending writes submitted to db, but not committed yet
+        self.flushing = []
+        self.flush_handle = None
+        # (table, ids) -> [lock, number of holders and waiters], see lock
+        self.locks = {}
+
+    @staticmethod
+    def where(ids):
+        return " AND ".join(f"{column}=?" for (column, value) in ids)
+
+    def overlay(self):
+        """yields all uncommitted writes, oldest first"""
+        for batch in self.flushing + [self.pending]:
+            yield from batch.items()
+
+    def pending_value(self, table, ids, key):
+        for batch in [self.pending] + self.flushing[::-1]:
+            if (table, ids, key) in batch:
+                return batch[(table, ids, key)]
+        return MISSING
+
+    def cache_get(self, table, cache_key):
+        if cache_key in self.cache:
+            (value, expires) = self.cache.get(cache_key)
+            if expires is None or expires > time.time():
+                self.hits[table] = self.hits.get(table, 0) + 1
+                return value
+            self.cache.pop(cache_key)
+        self.misses[table] = self.misses.get(table, 0) + 1
+        return MISSING
+
+    def invalidate(self, table, ids, key):
+        self.versions[(table, ids)] = self.versions.get((table, ids), 0) + 1
+        self.cache.pop(("keys", table, ids))
+        self.cache.pop(("value", table, ids, key))
+
+    async def get_keys(self, table, ids):
+        keys = self.cache_get(table, ("keys", table, ids))
+        if keys is MISSING:
+            version = self.versions.get((table, ids), 0)
+            r = await self.db.fetchall("kvstore_get_keys", f"""
+            SELECT key, expires
+            FROM {table}
+            WHERE {self.where(ids)} AND (expires IS NULL OR expires > ?);
+            """, tuple(value for (column, value) in ids) + (time.time(),))
+            keys = [k[0] for k in r]
+            # the key list is valid until its first key expires
+            expires = min((k[1] for k in r if k[1] is not None), default=None)
+            if self.versions.get((table, ids), 0) == version:
+                self.cache.put(("keys", table, ids), (keys, expires))
+        keys = list(keys)
+        now = time.time()
+        for ((t, i, key), entry) in self.overlay():
+            if t != table or i != ids:
+                continue
+            if live(entry, now) is DELETED:
+                if key in keys:
+                    keys.remove(key)
+            elif key not in keys:
+                keys.append(key)
+        return keys
+
+    async def get_value(self, table, ids, key):
+        entry = self.pending_value(table, ids, key)
+        if entry is not MISSING:
+            value = live(entry, time.time())
+            return None if value is DELETED else value
+        value = self.cache_get(table, ("value", table, ids, key))
+        if value is not MISSING:
+            return value
+        version = self.versions.get((table, ids), 0)
+        k = await self.db.fetchall("kvstore_get_value", f"""
+        SELECT value, expires
+        FROM {table}
+        WHERE {self.where(ids)} AND key=? AND (expires IS NULL OR expires > ?);
+        """, tuple(value for (column, value) in ids) + (key, time.time()))
+        (value, expires) = k[0] if k else (None, None)
+        if self.versions.get((table, ids), 0) == version:
+            self.cache.put(("value", table, ids, key), (value, expires))
+        return value
+
+    async def get_many(self, table, ids, keys):
+        """returns a dict key -> value (None if missing), reading all uncached keys in one job"""
+        result = {}
+        missing = []
+        now = time.time()
+        for key in keys:
+            entry = self.pending_value(table, ids, key)
+            if entry is not MISSING:
+                value = live(entry, now)
+                result[key] = None if value is DELETED else value
+                continue
+            value = self.cache_get(table, ("value", table, ids, key))
+            if value is not MISSING:
+                result[key] = value
+            else:
+                missing.append(key)
+        if not missing:
+            return result
+
+        def select(conn):
+            rows = []
+            for i in range(0, len(missing), MAX_KEYS_PER_STATEMENT):
+                chunk = tuple(missing[i:i+MAX_KEYS_PER_STATEMENT])
+                rows += conn.execute(f"""
+                SELECT key, value, expires
+                FROM {table}
+                WHERE {self.where(ids)} AND key IN ({",".join("?" * len(chunk))})
+                    AND (expires IS NULL OR expires > ?);
+                """, tuple(value for (column, value) in ids) + chunk + (now,)).fetchall()
+            return rows
+
+        version = self.versions.get((table, ids), 0)
+        found = {key: (value, expires) for (key, value, expires)
+                 in await self.db.run("kvstore_get_many", select)}
+        for key in missing:
+            (result[key], expires) = found.get(key, (None, None))
+            if self.versions.get((table, ids), 0) == version:
+                self.cache.put(("value", table, ids, key), (result[key], expires))
+        return result
+
+    async def scan(self, table, ids, prefix="", start=None, end=None, page_size=SCAN_PAGE_SIZE):
+        """
+        yields (key, value) of the keys starting with prefix and in [start, end)
+        ordered by key. Every query reads the next page_size rows after the
+        last key (keyset pagination), so only one page is in memory at a time.
+        Writes to the scope before the scan are flushed first, later ones
+        may or may not be seen.
+        """
+        if any(t == table and i == ids for ((t, i, key), value) in self.overlay()):
+            await self.flush()
+        lower = prefix if start is None else max(prefix, start)
+        last = None
+        while True:
+            conditions = [self.where(ids), "(expires IS NULL OR expires > ?)"]
+            params = [value for (column, value) in ids] + [time.time()]
+            if last is None:
+                conditions.append("key >= ?")
+                params.append(lower)
+            else:
+                conditions.append("key > ?")
+                params.append(last)
+            if end is not None:
+                conditions.append("key < ?")
+                params.append(end)
+            rows = await self.db.fetchall("kvstore_scan", f"""
+            SELECT key, value
+            FROM {table}
+            WHERE {" AND ".join(conditions)}
+            ORDER BY key
+            LIMIT ?;
+            """, tuple(params) + (page_size,))
+            for (key, value) in rows:
+                # sqlite orders text like python, the keys with the prefix are consecutive
+                if not key.startswith(prefix):
+                    return
+                yield (key, value)
+            if len(rows) < page_size:
+                return
+            last = rows[-1][0]
+
+    @contextlib.asynccontextmanager
+    async def lock(self, table, ids):
+        """
+        serializes the transactions of a scope, so a read-modify-write
+        doesn't lose concurrent updates. Plain writes don't take it.
+        """
+        scope = (table, ids)
+        if scope not in self.locks:
+            self.locks[scope] = [asyncio.Lock(), 0]
+        entry = self.locks[scope]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[scope]
+
+    def set_value(self, table, ids, key, value, ttl=None):
+        check_entry(key, value)
+        self.apply(table, ids, {key: (value, expiry(ttl))})
+
+    def set_many(self, table, ids, mapping, ttl=None):
+        for (key, value) in mapping.items():
+            check_entry(key, value)
+        expires = expiry(ttl)
+        self.apply(table, ids, {key: (value, expires) for (key, value) in mapping.items()})
+
+    def rem_value(self, table, ids, key):
+        check_key(key)
+        self.apply(table, ids, {key: (DELETED, None)})
+
+    def apply(self, table, ids, writes):
+        """
+        adds the writes (key -> (value or DELETED, expires)) to the pending ones.
+        As there is no await in between, they are committed in the same transaction.
+        """
+        for (key, entry) in writes.items():
+            self.invalidate(table, ids, key)
+            self.pending[(table, ids, key)] = entry
+        self.schedule_flush()
+
+    @staticmethod
+    def delete_expired(conn, table, now, limit):
+        """runs on the database thread, returns the number of deleted rows"""
+        c = conn.execute(f"""
+        DELETE FROM {table}
+        WHERE rowid IN (SELECT rowid
+                        FROM {table}
+                        WHERE expires <= ?
+                        LIMIT ?);
+        """, (now, limit))
+        conn.commit()
+        return c.rowcount
+
+    @staticmethod
+    def incremental_vacuum(conn, pages):
+        """runs on the database thread, returns the number of freed pages"""
+        before = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+        # execute would stop after the first freed page, the script runs it to the end
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        return before - conn.execute("PRAGMA freelist_count;").fetchone()[0]
+
+    async def sweep(self):
+        """
+        Deletes the expired entries and returns the freed pages to the file
+        system. It's done in many small database jobs, so other queries only
+        wait for one of them at a time.
+        """
+        now = time.time()
+        deleted = 0
+        for table in KV_TABLES:
+            while True:
+                n = await self.db.run("kvstore_sweep", self.delete_expired, table, now, SWEEP_BATCH_SIZE)
+                deleted += n
+                if n < SWEEP_BATCH_SIZE:
+                    break
+        freed = 0
+        while True:
+            n = await self.db.run("kvstore_vacuum", self.incremental_vacuum, VACUUM_PAGES)
+            freed += n
+            if n < VACUUM_PAGES:
+                break
+        if deleted or freed:
+            logging.info(f"Deleted {deleted} expired key-value store entries, freed {freed} pages")
+
+    def clear_cache(self):
+        self.cache = LRUCache(self.cache.max_bytes)
+
+    def get_cache_stats(self):
+        """Returns the cache hits and misses by table and the size of the cache"""
+        return {
+            "hits": dict(self.hits),
+            "misses": dict(self.misses),
+            "entries": len(self.cache.entries),
+            "bytes": self.cache.bytes,
+        }
+
+    def schedule_flush(self):
+        loop = asyncio.get_event_loop()
+        if len(self.pending) >= self.flush_size:
+            if self.flush_handle is not None:
+                self.flush_handle.cancel()
+            self.flush_handle = loop.call_soon(self.flush)
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.flush_interval, self.flush)
+
+    @staticmethod
+    def write_entry(c, table, ids, key, value, expires):
+        columns = [column for (column, v) in ids] + ["key"]
+        params = tuple(v for (column, v) in ids) + (key,)
+        if value is DELETED:
+            c.execute(f"""
+            DELETE FROM {table}
+            WHERE {KVStore.where(ids)} AND key=?;
+            """, params)
+        else:
+            c.execute(f"""
+            INSERT OR REPLACE INTO {table}({",".join(columns)},value,expires)
+            VALUES ({",".join("?" * (len(columns) + 2))});
+            """, params + (value, expires))
+
+    @staticmethod
+    def write_batch(conn, batch):
+        """
+        Runs on the database thread. If the batch fails, its entries are
+        written one by one and the ones that fail are dropped, so a single bad
+        entry can't block all writes. Returns the dropped entries as
+        (table, ids, key) -> exception. Operational errors (e.g. a locked
+        database or a full disk) are not the entries' fault, they fail the
+        whole batch.
+        """
+        c = conn.cursor()
+        try:
+            for ((table, ids, key), (value, expires)) in batch.items():
+                KVStore.write_entry(c, table, ids, key, value, expires)
+            conn.commit()
+            return {}
+        except sqlite3.OperationalError:
+            conn.rollback()
+            raise
+        except Exception:
+            conn.rollback()
+        dropped = {}
+        for ((table, ids, key), (value, expires)) in batch.items():
+            try:
+                KVStore.write_entry(c, table, ids, key, value, expires)
+                conn.commit()
+            except sqlite3.OperationalError:
+                conn.rollback()
+                raise
+            except Exception as e:
+                conn.rollback()
+                dropped[(table, ids, key)] = e
+        return dropped
+
+    def flush(self):
+        """
+        commits all pending writes in one transaction. Returns a future
+        that is done when they (and all earlier ones) are committed. It
+        fails if the batch has to be retried or entries of it were dropped.
+        """
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch = self.pending
+        self.pending = {}
+        if batch:
+            self.flushing.append(batch)
+        future = self.db.submit("kvstore_flush", self.write_batch, batch)
+        result = asyncio.get_event_loop().create_future()
+        # failures are logged below, flushes nobody awaits must not warn again
+        result.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+        def done(future):
+            self.flushing = [b for b in self.flushing if b is not batch]
+            if future.cancelled() or future.exception() is None:
+                # reads while the batch was uncommitted may have cached the old state
+                for (table, ids, key) in batch:
+                    self.invalidate(table, ids, key)
+                if future.cancelled():
+                    result.cancel()
+                    return
+                dropped = future.result()
+                for ((table, ids, key), e) in dropped.items():
+                    logging.warning(f"Dropped the write of key {key!r} to {table} {dict(ids)}: {e}")
+                if dropped:
+                    result.set_exception(ValueError(f"{len(dropped)} key-value store entries couldn't be written"))
+                else:
+                    result.set_result(None)
+                return
+            logging.warning(f"Writing {len(batch)} key-value store entries failed, retrying: {future.exception()}")
+            result.set_exception(future.exception())
+            # writes that happened since keep precedence
+            batch.update(self.pending)
+            self.pending = batch
+            if self.flush_handle is None:
+                self.flush_handle = asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+        future.add_done_callback(done)
+        return result
+
+
+class KVTransaction:
+    """
+    Collects the writes to a scope of a KVStore, see Plugin.kvstore_transaction.
+    Reads see the writes of the transaction.
+    """
+
+    def __init__(self, kvstore, table, ids):
+        self.kvstore = kvstore
+        self.table = table
+        self.ids = ids
+        # key -> (value or DELETED, expires)
+        self.writes = {}
+
+    async def get_keys(self):
+        keys = await self.kvstore.get_keys(self.table, self.ids)
+        now = time.time()
+        for (key, entry) in self.writes.items():
+            if live(entry, now) is DELETED:
+                if key in keys:
+                    keys.remove(key)
+            elif key not in keys:
+                keys.append(key)
+        return keys
+
+    async def get_value(self, key):
+        return (await self.get_many([key]))[key]
+
+    async def get_many(self, keys):
+        result = await self.kvstore.get_many(self.table, self.ids,
+                                             [k for k in keys if k not in self.writes])
+        now = time.time()
+        for key in keys:
+            if key in self.writes:
+                value = live(self.writes[key], now)
+                result[key] = None if value is DELETED else value
+        return result
+
+    async def set_value(self, key, value, ttl=None):
+        check_entry(key, value)
+        self.writes[key] = (value, expiry(ttl))
+
+    async def set_many(self, mapping, ttl=None):
+        for (key, value) in mapping.items():
+            check_entry(key, value)
+        expires = expiry(ttl)
+        self.writes.update((key, (value, expires)) for (key, value) in mapping.items())
+
+    async def rem_value(self, key):
+        check_key(key)
+        self.writes[key] = (DELETED, None)
+
+    def commit(self):
+        """returns a future which is done when the writes are committed"""
+        self.kvstore.apply(self.table, self.ids, self.writes)
+        return self.kvstore.flush()
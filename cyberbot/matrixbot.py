@@ -6,6 +6,7 @@ import importlib
 import logging
 import traceback
 import sqlite3
+import json
 import sys
 
 from pathlib import Path
@@ -13,6 +14,12 @@ from pprint import pprint
 
 from matrixroom import MatrixRoom
 from plugin import Plugin
+from scheduler import FairScheduler
+from pluginmanifest import ManifestCache
+from startupprofiler import StartupProfiler
+from kvstore import KVStore, KV_TABLES
+from dbexecutor import DBExecutor
+import plugintables
 
 import nio
 
@@ -23,11 +30,53 @@ DEFAULT_DBPATH = "./matrixbot.sqlite"
 DEFAULT_BIND_ADDRESS = "localhost"
 DEFAULT_BIND_PORT = "8080"
 DEFAULT_GLOBAL_PLUGINPATH = "./global_plugins"
+DEFAULT_EVENT_QUEUE_SIZE = "100"
+DEFAULT_EVENT_QUEUE_WAIT_WARNING = "5"
+DEFAULT_MAX_CONCURRENT_HANDLERS = "16"
+DEFAULT_ROOM_CONCURRENCY = "1"
+DEFAULT_PLUGIN_CONCURRENCY = "8"
+DEFAULT_HANDLER_TIMEOUT = "300"
+DEFAULT_HANDLER_SLOW_THRESHOLD = "5"
+DEFAULT_SYNC_TOKEN_MAX_AGE = "3600"
+DEFAULT_SYNC_TIMELINE_LIMIT = "10"
+DEFAULT_JOIN_CONCURRENCY = "4"
+DEFAULT_ROOM_LOAD_CONCURRENCY = "8"
+DEFAULT_ROOM_IDLE_TIMEOUT = "86400"
+# how often idle rooms are looked for (seconds)
+HIBERNATION_INTERVAL = 600
+DEFAULT_PLUGIN_RELOAD_INTERVAL = "10"
+DEFAULT_START_UNUSED_GLOBAL_PLUGINS = "false"
+DEFAULT_KVSTORE_FLUSH_INTERVAL = "1"
+DEFAULT_KVSTORE_FLUSH_SIZE = "100"
+DEFAULT_KVSTORE_CACHE_SIZE = "8388608"
+DEFAULT_KVSTORE_SWEEP_INTERVAL = "3600"
+DEFAULT_STATS_LOG_INTERVAL = "600"
+# how long to wait for newly joined rooms to show up in a sync (seconds)
+JOIN_SYNC_TIMEOUT = 90
+# minimum time between two writes of the sync token to the database
+SYNC_TOKEN_SAVE_INTERVAL = 30
+# timeline events the sync filter requests: messages, the only events plugin
+# handlers dispatch on, membership for invites/leaves, encrypted events (the
+# type of encrypted messages before decryption) and the state nio keeps track
+# of for sending messages
+TIMELINE_EVENT_TYPES = [
+    "m.room.message",
+    "m.room.member",
+    "m.room.encrypted",
+    "m.room.encryption",
+    "m.room.create",
+    "m.room.name",
+    "m.room.canonical_alias",
+    "m.room.power_levels",
+]
 
 class MatrixBot:
 
-    def __init__(self, config):
+    def __init__(self, config, startup_report=None):
         self.config = config
+        # wall times of the startup, written as json to startup_report if given
+        self.profiler = StartupProfiler()
+        self.startup_report = startup_report
 
         if not 'BotMatrixId' in config \
             or not all(key in config['BotMatrixId']
@@ -53,6 +102,9 @@ class MatrixBot:
                 sys.exit(-1)
 
         logging.info(f"Store path: {store_path}")
+        self.store_path = store_path
+        # access token and device id of the last login, see restore_session
+        self.session_path = store_path / "session.json"
 
         self.client = nio.AsyncClient(botc["SERVER"], botc["USERNAME"], device_id=botc.get("DEVICEID", DEFAULT_DEVICEID), store_path=str(store_path))
 
@@ -61,19 +113,70 @@ class MatrixBot:
 
         self.dbpath = botc.get("DBPATH", DEFAULT_DBPATH)
         self.load_db(self.dbpath)
+        # the database is only accessed on its own thread from now on
+        self.db = DBExecutor(self.conn)
+        # plugin key-value writes are committed in groups, see KVStore
+        self.kvstore = KVStore(self.db,
+                float(botc.get("KVSTORE_FLUSH_INTERVAL", DEFAULT_KVSTORE_FLUSH_INTERVAL)),
+                int(botc.get("KVSTORE_FLUSH_SIZE", DEFAULT_KVSTORE_FLUSH_SIZE)),
+                int(botc.get("KVSTORE_CACHE_SIZE", DEFAULT_KVSTORE_CACHE_SIZE)))
+        # expired key-value entries are deleted this often, 0 disables it
+        self.kvstore_sweep_interval = float(botc.get("KVSTORE_SWEEP_INTERVAL", DEFAULT_KVSTORE_SWEEP_INTERVAL))
         self.pluginpath = [p.strip() for p in botc.get("PLUGINPATH", DEFAULT_PLUGINPATH).split(";")]
         self.environment = dict((k.upper(),v) for k,v in dict(botc).items()
                                      if k.lower() != 'password')
         self.last_sync_time = 0
-
-        self.active_rooms = set()
+        # the next_batch token is persisted to resume syncing after a restart
+        self.sync_token_max_age = float(botc.get("SYNC_TOKEN_MAX_AGE", DEFAULT_SYNC_TOKEN_MAX_AGE))
+        self.last_sync_token_save = 0
+        self.sync_timeline_limit = int(botc.get("SYNC_TIMELINE_LIMIT", DEFAULT_SYNC_TIMELINE_LIMIT))
+        # invites are joined by a worker, see process_invites
+        self.join_concurrency = int(botc.get("JOIN_CONCURRENCY", DEFAULT_JOIN_CONCURRENCY))
+        self.invite_queue = asyncio.Queue()
+        self.room_load_concurrency = int(botc.get("ROOM_LOAD_CONCURRENCY", DEFAULT_ROOM_LOAD_CONCURRENCY))
+        # rooms without events for this long are hibernated, 0 disables it
+        self.room_idle_timeout = float(botc.get("ROOM_IDLE_TIMEOUT", DEFAULT_ROOM_IDLE_TIMEOUT))
+        # changed plugin files are reloaded, see watch_plugins. 0 disables it
+        self.plugin_reload_interval = float(botc.get("PLUGIN_RELOAD_INTERVAL", DEFAULT_PLUGIN_RELOAD_INTERVAL))
+        # global plugins no room plugin uses are only started on demand
+        self.start_unused_global_plugins = botc.get("START_UNUSED_GLOBAL_PLUGINS",
+                DEFAULT_START_UNUSED_GLOBAL_PLUGINS).lower() in ["true", "yes", "1"]
+        # the event queue, scheduler and database statistics are logged this often, 0 disables it
+        self.stats_log_interval = float(botc.get("STATS_LOG_INTERVAL", DEFAULT_STATS_LOG_INTERVAL))
+        self.pending_invites = set()
+        # local copy of the joined rooms, kept up to date from the sync responses
+        self.joined_room_ids = set()
+        # events are handled by a worker per room, see MatrixRoom.process_events
+        self.event_queue_size = int(botc.get("EVENT_QUEUE_SIZE", DEFAULT_EVENT_QUEUE_SIZE))
+        self.event_queue_wait_warning = float(botc.get("EVENT_QUEUE_WAIT_WARNING", DEFAULT_EVENT_QUEUE_WAIT_WARNING))
+        # plugin handlers of all rooms are run by the scheduler with per-room and per-plugin quotas
+        self.scheduler = FairScheduler(
+                max_concurrent=int(botc.get("MAX_CONCURRENT_HANDLERS", DEFAULT_MAX_CONCURRENT_HANDLERS)),
+                room_limit=int(botc.get("ROOM_CONCURRENCY", DEFAULT_ROOM_CONCURRENCY)),
+                plugin_limit=int(botc.get("PLUGIN_CONCURRENCY", DEFAULT_PLUGIN_CONCURRENCY)),
+                room_backlog=self.event_queue_size)
+        # time budget of a single handler call, see Plugin.run_handler
+        self.handler_timeout = float(botc.get("HANDLER_TIMEOUT", DEFAULT_HANDLER_TIMEOUT))
+        self.handler_slow_threshold = float(botc.get("HANDLER_SLOW_THRESHOLD", DEFAULT_HANDLER_SLOW_THRESHOLD))
+
+        # room_id -> MatrixRoom, the single place to look up rooms the bot is active in
+        self.active_rooms = {}
         self.available_plugins = {}
-        # order of global_plugins is important as they may depend on each other
-        # also the non-global plugins may depend on them
-        # thus we map by index between names and plugins and do not use a dict()
+        # pluginname -> module, see load_plugin_module
+        self.plugin_modules = {}
+        # pluginname -> statically read module variables, see read_plugins
+        self.plugin_manifests = {}
+        self.manifest_cache = ManifestCache(store_path / "plugin_manifests.json")
+        # global plugins declare the global plugins they depend on in DEPENDS,
+        # room plugins the ones they use in GLOBAL_DEPENDS
+        # we map by index between names and plugins and do not use a dict()
         self.global_pluginpath = botc.get("GLOBAL_PLUGINPATH", DEFAULT_GLOBAL_PLUGINPATH)
-        self.global_plugin_names = [p.strip() for p in botc.get("GLOBAL_PLUGINS", "").split(";")]
+        self.global_plugin_names = [p.strip() for p in botc.get("GLOBAL_PLUGINS", "").split(";") if p.strip()]
         self.global_plugins = [None] * len(self.global_plugin_names)
+        # global plugin name -> task running its set_bot and start
+        self.global_plugin_starts = {}
+        # pluginname -> (module, future of the migration of its tables)
+        self.plugin_migrations = {}
 
 
         # this is a small hack to add the plugins to the import search path
@@ -81,19 +184,207 @@ class MatrixBot:
             sys.path.append(path)
         sys.path.append(self.global_pluginpath)
 
+    def get_room(self, room_id):
+        """Returns the active MatrixRoom for room_id or None"""
+        return self.active_rooms.get(room_id)
+
+    def add_room(self, mroom):
+        self.active_rooms[mroom.room_id] = mroom
+        mroom.start_worker()
+
+    async def remove_room(self, room_id):
+        """Unregisters a room (e.g. after leaving it) and stops its plugins.
+        The database entries are kept, so the room is restored on rejoin."""
+        mroom = self.active_rooms.pop(room_id, None)
+        if mroom is None:
+            return
+        logging.info(f"Removing room {room_id}")
+        await mroom.stop_worker()
+        self.scheduler.cancel_room(room_id)
+        await asyncio.gather(*(p.stop_all_tasks() for p in mroom.plugins))
+
+    def get_db_stats(self):
+        """Returns the latency statistics of the database operations by operation"""
+        return self.db.get_stats()
+
+    def get_kvstore_cache_stats(self):
+        """Returns the hits and misses of the key-value store cache"""
+        return self.kvstore.get_cache_stats()
+
+    def get_queue_stats(self):
+        """Returns the event queue statistics of all active rooms by room_id"""
+        return {room_id: mroom.get_queue_stats()
+                for (room_id, mroom) in self.active_rooms.items()}
+
+    def format_stats(self):
+        """Returns a summary of the event queue, scheduler and database statistics for the log"""
+        queues = self.get_queue_stats()
+        scheduler = self.scheduler.get_stats()
+        summary = (f"{len(queues)} rooms, {sum(q['depth'] for q in queues.values())} queued"
+                   f" and {sum(q['processed'] for q in queues.values())} processed events,"
+                   f" {scheduler['running']} running and {scheduler['pending']} pending handlers")
+        slowest = sorted(((q["max_wait"], room_id) for (room_id, q) in queues.items()
+                          if q["processed"]), reverse=True)[:5]
+        for (wait, room_id) in slowest:
+            q = queues[room_id]
+            summary += (f"\n  room {room_id}: depth {q['depth']}, avg wait {q['avg_wait']:.2f}s,"
+                        f" max wait {wait:.2f}s")
+        for (pluginname, running) in sorted(scheduler["running_plugins"].items()):
+            summary += f"\n  plugin {pluginname}: {running} running"
+        cache = self.get_kvstore_cache_stats()
+        hits = sum(cache["hits"].values())
+        misses = sum(cache["misses"].values())
+        summary += (f"\n  kvstore cache: {hits} hits, {misses} misses"
+                    f" ({hits / (hits + misses) if hits + misses else 0:.0%}),"
+                    f" {cache['entries']} entries, {cache['bytes']} bytes")
+        for (op, stats) in sorted(self.get_db_stats().items()):
+            # upper bound of the slowest non-empty latency bucket
+            slowest = [b for (b, count) in stats["histogram"].items() if count][-1]
+            summary += (f"\n  db {op}: {stats['count']} calls, mean {stats['mean'] * 1000:.1f}ms,"
+                        f" slowest <= {slowest}s")
+        return summary
+
+    async def log_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_log_interval)
+            try:
+                logging.info(self.format_stats())
+            except Exception as e:
+                traceback.print_exc()
+                logging.warning(f"Logging the statistics failed: {e}")
+
     def get_global_plugin_object(self, name):
         i = self.global_plugin_names.index(name)
         return self.global_plugins[i].Object
 
 
-    async def start_global_plugins(self):
-        for i in range(len(self.global_plugin_names)):
+    def get_global_plugin_depends(self, name):
+        i = self.global_plugin_names.index(name)
+        return getattr(self.global_plugins[i], "DEPENDS", [])
+
+    def check_global_plugins(self):
+        """
+        Exits if a global plugin failed to load, depends on a global plugin
+        that is not configured or if the dependencies contain a cycle.
+        """
+        for (name, module) in zip(self.global_plugin_names, self.global_plugins):
+            if module is None:
+                logging.error(f"Global plugin {name} could not be loaded")
+                sys.exit(-1)
+            for dep in self.get_global_plugin_depends(name):
+                if dep not in self.global_plugin_names:
+                    logging.error(f"Global plugin {name} depends on {dep}, which is not in GLOBAL_PLUGINS")
+                    sys.exit(-1)
+
+        # depth first search, a global plugin still on the path means a cycle
+        done = set()
+        def visit(name, path):
+            if name in path:
+                cycle = " -> ".join(path[path.index(name):] + [name])
+                logging.error(f"Global plugins have a dependency cycle: {cycle}")
+                sys.exit(-1)
+            if name in done:
+                return
+            for dep in self.get_global_plugin_depends(name):
+                visit(dep, path + [name])
+            done.add(name)
+        for name in self.global_plugin_names:
+            visit(name, [])
+
+    async def get_used_global_plugins(self):
+        """returns the global plugins the plugins enabled in any room depend on, directly or not"""
+        r = await self.db.fetchall("get_used_global_plugins", "SELECT DISTINCT pluginname FROM room_plugins;")
+        pluginnames = [pluginname for (pluginname,) in r]
+        todo = [name for pluginname in pluginnames
+                for name in self.plugin_manifests.get(pluginname, {}).get("GLOBAL_DEPENDS", [])
+                if name in self.global_plugin_names]
+        used = set()
+        while todo:
+            name = todo.pop()
+            if name not in used:
+                used.add(name)
+                todo.extend(self.get_global_plugin_depends(name))
+        return used
+
+    async def ensure_global_plugins(self, names):
+        """
+        Starts the given global plugins and their dependencies unless they
+        are started already. Global plugins not depending on each other are
+        started at the same time.
+        """
+        for name in names:
+            if name not in self.global_plugin_names:
+                raise ValueError(f"global plugin {name} is not in GLOBAL_PLUGINS")
+        await asyncio.gather(*(self.start_global_plugin(name) for name in names))
+
+    def start_global_plugin(self, name):
+        """returns the task starting the global plugin name after its dependencies"""
+        if name in self.global_plugin_starts:
+            return self.global_plugin_starts[name]
+
+        async def run():
+            await self.ensure_global_plugins(self.get_global_plugin_depends(name))
+            logging.info(f"Starting global plugin {name}")
+            start = time.monotonic()
+            obj = self.get_global_plugin_object(name)
             # it's the plugin's job to set up that this works
-            await self.global_plugins[i].Object.set_bot(self)
-            await self.global_plugins[i].Object.start()
+            await obj.set_bot(self)
+            await obj.start()
+            self.profiler.record_global_plugin(name, time.monotonic() - start)
 
+        self.global_plugin_starts[name] = asyncio.create_task(run())
+        return self.global_plugin_starts[name]
 
-    async def login(self):
+    async def start_global_plugins(self):
+        self.check_global_plugins()
+        if self.start_unused_global_plugins:
+            names = self.global_plugin_names
+        else:
+            used = await self.get_used_global_plugins()
+            names = [name for name in self.global_plugin_names if name in used]
+            unused = [name for name in self.global_plugin_names if name not in used]
+            if unused:
+                logging.info(f"Not starting unused global plugins: {', '.join(unused)}")
+        await self.ensure_global_plugins(names)
+
+
+    def restore_session(self):
+        """
+        Restores the session of the last login from the session file instead
+        of logging in with the password. Returns False if there is none.
+        """
+        if not self.session_path.exists():
+            return False
+        try:
+            with open(self.session_path) as f:
+                session = json.load(f)
+            if session["username"] != self.client.user:
+                logging.info("Stored session belongs to another user, ignoring it")
+                return False
+            self.client.access_token = session["access_token"]
+            self.client.user_id = session["user_id"]
+            self.client.device_id = session["device_id"]
+            # this is what nio does after a successful login
+            self.client.load_store()
+        except Exception as e:
+            logging.warning(f"Couldn't restore stored session: {e}")
+            return False
+        logging.info(f"Restored session of device {self.client.device_id}")
+        return True
+
+    def save_session(self):
+        session = {
+            "username": self.client.user,
+            "user_id": self.client.user_id,
+            "device_id": self.client.device_id,
+            "access_token": self.client.access_token,
+        }
+        # the access token is a credential, only the bot's user may read it
+        fd = os.open(self.session_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(session, f)
+
+    async def password_login(self):
         import socket
         hname = socket.gethostname()
         response = await self.client.login(self.password, device_name=hname)
@@ -101,8 +392,50 @@ class MatrixBot:
             logging.error("""There was an error while logging in. Please check
 credentials""")
             sys.exit(-1)
-        k = await self.client.sync() # otherwise all past messages will be handled
+        self.save_session()
+
+    async def initial_sync(self):
+        # otherwise all past messages will be handled
+        sync_filter = self.build_sync_filter()
+        token, saved = await self.load_sync_token()
+        if token is not None and time.time() - saved <= self.sync_token_max_age:
+            # nio keeps the room state in memory only, so the full state is
+            # still needed to know all rooms. The token only saves the
+            # timeline events since the last run
+            logging.info("Resuming sync from stored token")
+            k = await self.timed_sync("resumed", sync_filter=sync_filter, since=token, full_state=True)
+            if type(k) == nio.SyncError and k.status_code != "M_UNKNOWN_TOKEN":
+                logging.warning(f"Resuming sync failed ({k.message}), doing a fresh sync")
+                self.client.next_batch = None
+                k = await self.timed_sync("fresh", sync_filter=sync_filter)
+        else:
+            k = await self.timed_sync("fresh", sync_filter=sync_filter)
+        return k
+
+    async def timed_sync(self, kind, **kwargs):
+        """syncs once and records its size in the startup report"""
+        start = time.monotonic()
+        k = await self.client.sync(**kwargs)
+        self.profiler.record_sync(kind, time.monotonic() - start, k)
+        return k
+
+    async def login(self):
+        with self.profiler.phase("login"):
+            restored = self.restore_session()
+            if not restored:
+                await self.password_login()
+        with self.profiler.phase("initial_sync"):
+            k = await self.initial_sync()
+        if restored and type(k) == nio.SyncError and k.status_code == "M_UNKNOWN_TOKEN":
+            logging.warning("Stored access token was rejected, logging in with password")
+            with self.profiler.phase("password_login"):
+                await self.password_login()
+            # kept apart from the failed attempt, both show up in the report
+            with self.profiler.phase("initial_sync_retry"):
+                k = await self.initial_sync()
         self.last_sync_time = time.time()
+        await self.save_sync_token()
+        self.joined_room_ids = set(self.client.rooms)
         if self.client.should_upload_keys:
             await self.client.keys_upload()
         cur_displayname = (await self.client.get_displayname()).displayname
@@ -111,18 +444,69 @@ credentials""")
             logging.info(f"Changing displayname to {self.botname}")
             await self.client.set_displayname(self.botname)
 
+    def build_sync_filter(self):
+        """
+        Returns a sync filter which only requests the event types the bot
+        and the plugin handlers dispatch on. Presence, typing, receipts and
+        account data are never used and left out.
+        """
+        return {
+            "presence": {"not_types": ["*"]},
+            "account_data": {"not_types": ["*"]},
+            "room": {
+                "account_data": {"not_types": ["*"]},
+                "ephemeral": {"not_types": ["*"]},
+                "state": {"lazy_load_members": True},
+                "timeline": {
+                    "types": TIMELINE_EVENT_TYPES,
+                    "limit": self.sync_timeline_limit,
+                    "lazy_load_members": True,
+                },
+            },
+        }
+
     async def __aenter__(self):
         await self.login()
         return self
 
 
     async def __aexit__(self, exc_type, exc_value, exc_tb):
+        await self.kvstore.flush()
+        await self.save_sync_token()
         await self.client.close()
+        self.db.close()
+
+    async def load_sync_token(self):
+        """Returns the stored next_batch token and the time it was stored"""
+        r = await self.db.fetchall("load_sync_token", """
+        SELECT key, value
+        FROM bot_data
+        WHERE key IN ('next_batch', 'next_batch_time');
+        """)
+        values = dict(r)
+        if "next_batch" not in values or "next_batch_time" not in values:
+            return None, 0
+        return values["next_batch"], float(values["next_batch_time"])
+
+    async def save_sync_token(self):
+        token = self.client.next_batch
+        if not token:
+            return
+        self.last_sync_token_save = time.time()
+        await self.db.executemany("save_sync_token", """
+        INSERT OR REPLACE INTO bot_data(key,value)
+        VALUES (?,?);
+        """, [("next_batch", token), ("next_batch_time", str(time.time()))])
 
 
     def load_db(self, dbname):
-        self.conn = sqlite3.connect(dbname)
+        # only used by the DBExecutor thread after loading
+        self.conn = sqlite3.connect(dbname, check_same_thread=False)
         c = self.conn.cursor()
+        # readers don't block the writer and a commit doesn't need to wait
+        # for the database file, only for the log
+        c.execute("PRAGMA journal_mode=WAL;")
+        c.execute("PRAGMA synchronous=NORMAL;")
         tables = c.execute("""
             SELECT name
             FROM sqlite_master
@@ -156,6 +540,7 @@ credentials""")
                 roomid     VARCHAR,
                 key        VARCHAR,
                 value      TEXT,
+                expires    REAL,
                 PRIMARY KEY (roomid, key)
             );
             """)
@@ -164,6 +549,7 @@ credentials""")
                 pluginname VARCHAR,
                 key        VARCHAR,
                 value      TEXT,
+                expires    REAL,
                 PRIMARY KEY (pluginname, key)
             );
             """)
@@ -173,27 +559,80 @@ credentials""")
                 pluginname VARCHAR,
                 key        VARCHAR,
                 value      TEXT,
+                expires    REAL,
                 PRIMARY KEY (roomid, pluginname, key)
             );
             """)
+        # expires: time (unix seconds) after which a key-value entry is hidden
+        # and deleted by KVStore.sweep, NULL for never. Older databases lack it
+        for table in KV_TABLES:
+            columns = [r[1] for r in c.execute(f"PRAGMA table_info({table});").fetchall()]
+            if "expires" not in columns:
+                c.execute(f"ALTER TABLE {table} ADD COLUMN expires REAL;")
+            c.execute(f"CREATE INDEX IF NOT EXISTS {table}_expires ON {table}(expires);")
+        # the pages freed by deleting are returned to the file system by
+        # KVStore.sweep, switching an existing database rebuilds it once
+        if c.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+            logging.info("Enabling incremental vacuum of the database")
+            c.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+            c.execute("VACUUM;")
+        # plugin_schemas: version of the tables of each plugin, see plugintables.migrate
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS plugin_schemas (
+            pluginname VARCHAR PRIMARY KEY,
+            version    INTEGER
+        );
+        """)
+        # bot_data: data of the bot itself, e.g. the last sync token
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS bot_data (
+            key        VARCHAR PRIMARY KEY,
+            value      TEXT
+        );
+        """)
 
 
     async def load_rooms(self):
+        """
+        Loads the plugins of all rooms, ROOM_LOAD_CONCURRENCY rooms at a time.
+        A room is registered before loading, so its events are queued, and
+        its worker starts as soon as its plugins are loaded.
+        """
         joined_rooms = self.client.rooms
-        cursor = self.conn.cursor()
-        res = cursor.execute("""
-        SELECT *
+        res = await self.db.fetchall("load_rooms", """
+        SELECT roomid
         FROM rooms;
         """)
-        dbrooms = res.fetchall()
-        for rid,nio_room in joined_rooms.items():
-            if (rid,) in dbrooms:
+        dbrooms = {rid for (rid,) in res}
+        semaphore = asyncio.Semaphore(self.room_load_concurrency)
+
+        async def load_room(nio_room):
+            async with semaphore:
+                start = time.monotonic()
                 mr = MatrixRoom(
                         matrixbot=self,
                         nio_room=nio_room,
                     )
-                await mr.load_plugins()
-                self.active_rooms.add(mr)
+                self.active_rooms[mr.room_id] = mr
+                try:
+                    await mr.load_plugins()
+                except Exception as e:
+                    traceback.print_exc()
+                    logging.warning(f"Loading room {mr.room_id} failed: {e}")
+                    self.active_rooms.pop(mr.room_id, None)
+                    return
+                # the room may have been left while loading
+                if self.active_rooms.get(mr.room_id) is mr:
+                    mr.start_worker()
+                duration = time.monotonic() - start
+                self.profiler.record_room(mr.room_id, duration)
+                logging.info(f"Loaded room {mr.room_id} ({len(mr.plugins)} plugins) in {duration:.2f}s")
+
+        with self.profiler.phase("load_rooms"):
+            rooms = [nio_room for (rid, nio_room) in joined_rooms.items() if rid in dbrooms]
+            await asyncio.gather(*(load_room(nio_room) for nio_room in rooms))
+        logging.info(f"Loaded {len(rooms)} rooms in {self.profiler.phases['load_rooms']:.2f}s")
+        self.profiler.finish(self.startup_report)
 
     async def read_plugins(self):
         plugin_paths = [Path(path) for path in self.pluginpath]
@@ -214,18 +653,134 @@ credentials""")
                     logging.warning(e)
         # plugins must be called ...plugin.py, so other modules in the same
         # directory are not falsely loaded (allows for plugin decomposition)
+        # the plugin modules are not imported here, only when a room loads them
         for plugin_path in plugin_paths:
             for path in plugin_path.glob("*_plugin.py"):
                 if path.exists():
-                    modname = f'plugins.{path.stem}'
-                    loader = importlib.machinery.SourceFileLoader(modname, str(path))
+                    pluginname = path.stem.replace("_plugin","")
+                    if pluginname in self.available_plugins:
+                        # the first plugin path wins, as in find_plugin_file
+                        continue
                     try:
-                        module = loader.load_module(modname)
-                        pluginname = path.stem.replace("_plugin","")
-                        self.available_plugins[pluginname] = module.HELP_DESC
+                        self.read_plugin_manifest(pluginname, path)
                     except Exception as e:
                         logging.warning(e)
+        self.manifest_cache.save()
+        await self.enter_plugins_to_db()
+
+    def read_plugin_manifest(self, pluginname, path):
+        manifest = self.manifest_cache.get(path)
+        if "HELP_DESC" not in manifest:
+            # not a literal, we have to execute the module
+            module = self.load_plugin_module(pluginname)
+            manifest = dict(manifest, HELP_DESC=module.HELP_DESC)
+            self.manifest_cache.set(path, manifest)
+        self.plugin_manifests[pluginname] = manifest
+        self.available_plugins[pluginname] = manifest["HELP_DESC"]
+
+    def get_plugin_files(self):
+        """returns pluginname -> path of all plugin files, the first plugin path wins"""
+        files = {}
+        for plugin_path in self.pluginpath:
+            for path in Path(plugin_path).resolve().glob("*_plugin.py"):
+                files.setdefault(path.stem.replace("_plugin",""), path)
+        return files
+
+    async def watch_plugins(self):
+        """
+        Polls the mtimes of the plugin files and reloads changed plugins.
+        New plugin files become available.
+        """
+        def mtimes():
+            result = {}
+            for (pluginname, path) in self.get_plugin_files().items():
+                try:
+                    result[pluginname] = path.stat().st_mtime
+                except FileNotFoundError:
+                    pass
+            return result
+
+        known = mtimes()
+        while True:
+            await asyncio.sleep(self.plugin_reload_interval)
+            current = mtimes()
+            changed = [pluginname for (pluginname, mtime) in current.items()
+                       if known.get(pluginname) != mtime]
+            known = current
+            for pluginname in changed:
+                try:
+                    await self.reload_plugin(pluginname)
+                except Exception as e:
+                    traceback.print_exc()
+                    logging.warning(f"Reloading plugin {pluginname} failed: {e}")
+
+    async def reload_plugin(self, pluginname):
+        """
+        Recompiles a changed plugin and re-registers it in the rooms it is
+        enabled in. If the new version doesn't compile, the old one keeps running.
+        """
+        logging.info(f"Reloading plugin {pluginname}")
+        path = self.find_plugin_file(pluginname)
+        old_module = self.plugin_modules.pop(pluginname, None)
+        modname = f'plugins.{pluginname}'
+        # load_module would execute the new code into the old module object
+        sys.modules.pop(modname, None)
+        try:
+            if old_module is not None:
+                self.load_plugin_module(pluginname)
+            self.read_plugin_manifest(pluginname, path)
+        except Exception:
+            if old_module is not None:
+                self.plugin_modules[pluginname] = old_module
+                sys.modules[modname] = old_module
+            raise
+        self.manifest_cache.save()
         await self.enter_plugins_to_db()
+        for mroom in list(self.active_rooms.values()):
+            await mroom.reload_plugin(pluginname)
+
+    def find_plugin_file(self, pluginname):
+        filename = pluginname + "_plugin.py"
+        for path in self.pluginpath:
+            p = Path(path).resolve()
+            if (p / filename ).exists():
+                return p / filename
+        return None
+
+    async def migrate_plugin_tables(self, pluginname, module):
+        """
+        Creates or migrates the tables declared in the MIGRATIONS of a plugin
+        module, once per module (a reloaded module is checked again).
+        """
+        migrations = getattr(module, "MIGRATIONS", None)
+        if not migrations:
+            return
+        if pluginname not in self.plugin_migrations or self.plugin_migrations[pluginname][0] is not module:
+            # migrations may move data out of the key-value store, it must be written first
+            self.kvstore.flush()
+            future = self.db.submit("migrate_plugin_tables", plugintables.migrate, pluginname, migrations)
+            future.add_done_callback(lambda f: self.kvstore.clear_cache())
+            self.plugin_migrations[pluginname] = (module, future)
+        await self.plugin_migrations[pluginname][1]
+
+    def load_plugin_module(self, pluginname):
+        """
+        Returns the module of a plugin. Every plugin module is executed only
+        once and shared by all rooms, the per-room state lives in the
+        register_to call of each room.
+        """
+        if pluginname in self.plugin_modules:
+            return self.plugin_modules[pluginname]
+        full_plugin_path = self.find_plugin_file(pluginname)
+        if full_plugin_path is None:
+            raise FileNotFoundError(f"plugin {pluginname}: file does not exist")
+        logging.info(f"Loading plugin module {full_plugin_path}")
+        modname = f'plugins.{pluginname}'
+        loader = importlib.machinery.SourceFileLoader(modname, str(full_plugin_path))
+        module = loader.load_module(modname)
+        module.ENVIRONMENT = self.environment.copy()
+        self.plugin_modules[pluginname] = module
+        return module
 
     async def enter_plugins_to_db(self):
         # we now check, if all loaded plugins have an entry in the database
@@ -233,41 +788,117 @@ credentials""")
         # TODO: - do we want to remove database entries when a plugin disappears?
         #         problem: development of plugin with errors -> deletion?!?! not wanted!
         #       - How do we guarantee the uniqueness of filenames among directories?
-        cursor = self.conn.cursor()
-        res = cursor.execute("""
+        dbplugins = await self.db.fetchall("enter_plugins_to_db", """
         SELECT *
         FROM plugins;
         """)
-        dbplugins = res.fetchall()
-        for ap in list(self.available_plugins.keys()) + self.global_plugin_names:
-            if (ap,) not in dbplugins:
-                # add plugin to db
-                self.conn.execute("""
-                INSERT INTO plugins (pluginname) VALUES (?);
-                """, (ap,))
-                self.conn.commit()
+        new_plugins = [(ap,) for ap in list(self.available_plugins.keys()) + self.global_plugin_names
+                       if (ap,) not in dbplugins]
+        if new_plugins:
+            # add plugins to db
+            await self.db.executemany("enter_plugins_to_db", """
+            INSERT INTO plugins (pluginname) VALUES (?);
+            """, new_plugins)
+
+    async def join_room(self, room_id, semaphore):
+        async with semaphore:
+            logging.info(f"Try joining room {room_id}")
+            response = await self.client.join(room_id)
+        if type(response) == nio.responses.JoinResponse:
+            self.joined_room_ids.add(room_id)
+            return True
+        logging.warning(f"Couldn't joing the room: {response}")
+        return False
+
+    async def wait_for_rooms(self, room_ids):
+        """waits until all rooms are known from a sync or JOIN_SYNC_TIMEOUT is over"""
+        deadline = time.monotonic() + JOIN_SYNC_TIMEOUT
+        while any(rid not in self.client.rooms for rid in room_ids):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self.client.synced.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+
+    async def process_invites(self):
+        """
+        Joins the rooms the bot is invited to. All invites that arrived
+        together are joined in parallel and the new rooms are set up
+        together once the sync loop delivered their state.
+        """
+        semaphore = asyncio.Semaphore(self.join_concurrency)
+        while True:
+            room_ids = [await self.invite_queue.get()]
+            while not self.invite_queue.empty():
+                room_ids.append(self.invite_queue.get_nowait())
+            try:
+                results = await asyncio.gather(*(self.join_room(rid, semaphore) for rid in room_ids))
+                joined = [rid for (rid, ok) in zip(room_ids, results) if ok]
+                if not joined:
+                    continue
+                await self.wait_for_rooms(joined)
+                new_rooms = []
+                for rid in joined:
+                    if rid in self.client.rooms:
+                        new_rooms.append(self.client.rooms[rid])
+                    else:
+                        logging.warning(f"Joined room {rid} did not show up in a sync")
+                mrooms = await asyncio.gather(*(MatrixRoom.new(self, nio_room) for nio_room in new_rooms))
+                for mroom in mrooms:
+                    self.add_room(mroom)
+            except Exception as e:
+                traceback.print_exc()
+                logging.warning(e)
+            finally:
+                self.pending_invites.difference_update(room_ids)
+
+    def get_resident_rooms(self):
+        return [mroom for mroom in self.active_rooms.values() if mroom.resident]
+
+    async def hibernate_idle_rooms(self):
+        while True:
+            await asyncio.sleep(HIBERNATION_INTERVAL)
+            now = time.monotonic()
+            idle = [mroom for mroom in self.get_resident_rooms()
+                    if now - mroom.last_activity > self.room_idle_timeout]
+            for mroom in idle:
+                try:
+                    await mroom.hibernate()
+                except Exception as e:
+                    traceback.print_exc()
+                    logging.warning(f"Hibernating room {mroom.room_id} failed: {e}")
+            # the destructors of the unloaded plugins persisted their state
+            if idle:
+                try:
+                    await self.kvstore.flush()
+                except Exception as e:
+                    traceback.print_exc()
+                    logging.warning(f"Writing the state of the hibernated rooms failed: {e}")
+            logging.info(f"{len(self.get_resident_rooms())} of {len(self.active_rooms)} rooms resident")
+
+    async def sweep_kvstore(self):
+        while True:
+            await asyncio.sleep(self.kvstore_sweep_interval)
+            try:
+                await self.kvstore.sweep()
+            except Exception as e:
+                traceback.print_exc()
+                logging.warning(f"Sweeping the key-value store failed: {e}")
 
     async def listen(self):
 
         async def handle_invite_event(room, event):
-            try:
-                jrooms = await self.client.joined_rooms()
-                jrooms = jrooms.rooms
-            except:
-                logging.warning(f"Not joining room {room.room_id}")
+            # the invite state contains several events, we only need our own invite
+            if event.state_key != self.client.user_id or event.membership != "invite":
                 return
-            if room.room_id not in jrooms:
-                logging.info(f"Try joining room {room.room_id}")
-                await asyncio.sleep(0.5)
-                response = await self.client.join(room.room_id)
-                await asyncio.sleep(0.5)
-                if type(response) == nio.responses.JoinResponse:
-                    self.active_rooms.add(await MatrixRoom.new(self,room))
-                else:
-                    logging.warning(f"Couldn't joing the room: {response}")
-            else:
+            if room.room_id in self.joined_room_ids:
                 logging.warning(f"Not joining room {room.room_id}")
                 logging.warning(f"Already joined.")
+            elif room.room_id not in self.pending_invites:
+                self.pending_invites.add(room.room_id)
+                self.invite_queue.put_nowait(room.room_id)
 
 
         async def handle_text_event(room, event):
@@ -282,26 +913,10 @@ credentials""")
                 logging.debug("Ignoring own message")
                 return
 
-            matching_rooms = [mroom for mroom in self.active_rooms if
-                    mroom.room_id == room.room_id]
-            if matching_rooms:
-                try:
-                    await matching_rooms[0].handle_text_event(event)
-                except Exception as e:
-                    traceback.print_exc()
-                    logging.warning(e)
-                    try:
-                        k = traceback.format_exc()
-                        if "ADMIN" in self.environment:
-                            admin = self.environment['ADMIN']
-                            k += f"\nPlease contact {admin} for bug fixing"
-                        else:
-                            k += "\nPlease contact the plugin creator"
-                        self.nio_room = room
-                        await Plugin.send_text(self, k)
-                    except Exception as e:
-                        traceback.print_exc()
-                        logging.warning(e)
+            mroom = self.get_room(room.room_id)
+            if mroom is not None:
+                # the room's worker handles the event, so the sync loop can go on
+                await mroom.enqueue_event(event)
             else:
                 logging.info("Ignoring text event in non-active room")
 
@@ -309,8 +924,9 @@ credentials""")
             event = args[0]
             logging.debug(80 * "=")
             #pprint(vars(event))
-            if room.room_id in self.client.rooms:
-                logging.debug(f"{type(event)} in room {self.client.rooms[room.room_id].display_name})")
+            mroom = self.get_room(room.room_id)
+            if mroom is not None:
+                logging.debug(f"{type(event)} in room {mroom.nio_room.display_name})")
             else:
                 logging.debug(type(event), "in room", room.room_id)
 
@@ -319,8 +935,13 @@ credentials""")
             elif type(event) == nio.events.room_events.RoomMessageText:
                 await handle_text_event(room, event)
             elif type(event) == nio.events.room_events.RoomMemberEvent:
-                name = event.source.get("sender")
-                logging.info(f"{name} joined room")
+                if event.state_key == self.client.user_id and event.membership in ["leave", "ban"]:
+                    logging.info(f"Left room {room.room_id} ({event.membership})")
+                    self.joined_room_ids.discard(room.room_id)
+                    await self.remove_room(room.room_id)
+                else:
+                    name = event.source.get("sender")
+                    logging.info(f"{name} joined room")
             elif type(event) == nio.MegolmEvent:
                 logging.debug("account shared:", self.client.olm_account_shared)
                 logging.warning("Unable to decrypt event")
@@ -339,7 +960,11 @@ credentials""")
             logging.debug("Got response")
             logging.debug(type(response))
             self.last_sync_time = time.time()
-            logging.debug("Ignoring response")
+            if isinstance(response, nio.SyncResponse):
+                self.joined_room_ids.update(response.rooms.join.keys())
+                self.joined_room_ids.difference_update(response.rooms.leave.keys())
+                if self.last_sync_time - self.last_sync_token_save > SYNC_TOKEN_SAVE_INTERVAL:
+                    await self.save_sync_token()
 
         async def todevice_cb(request):
             logging.debug(80 * "=")
@@ -375,10 +1000,22 @@ credentials""")
             for room_id in self.active_rooms:
                 await self.introduce_bot(room_id)
 
-        await self.client.sync_forever(30000)
+        self.invite_worker = asyncio.create_task(self.process_invites())
+        if self.room_idle_timeout > 0:
+            self.hibernator = asyncio.create_task(self.hibernate_idle_rooms())
+        if self.kvstore_sweep_interval > 0:
+            self.kvstore_sweeper = asyncio.create_task(self.sweep_kvstore())
+        if self.stats_log_interval > 0:
+            self.stats_logger = asyncio.create_task(self.log_stats())
+        if self.plugin_reload_interval > 0:
+            self.plugin_watcher = asyncio.create_task(self.watch_plugins())
+        await self.client.sync_forever(30000, sync_filter=self.build_sync_filter())
 
     async def start(self):
-        await self.read_plugins()
-        await self.start_global_plugins()
-        await self.load_rooms()
+        with self.profiler.phase("read_plugins"):
+            await self.read_plugins()
+        with self.profiler.phase("start_global_plugins"):
+            await self.start_global_plugins()
+        # rooms already loaded answer while the others are still loading
+        self.room_loader = asyncio.create_task(self.load_rooms())
         await self.listen()
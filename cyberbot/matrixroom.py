@@ -2,10 +2,13 @@ import asyncio
 import nio
 import logging
 import importlib
+import time
+import traceback
 
 from itertools import compress
 
 from plugin import Plugin
+from commandrouter import CommandRouter
 
 nio.RoomMember.get_friendly_name = lambda self: self.display_name
 
@@ -21,17 +24,33 @@ class MatrixRoom():
         self.room_id = nio_room.room_id
         self.client = matrixbot.client
         self.plugins = []
+        self.router = CommandRouter()
+
+        # events are handled in order by a worker task, decoupled from the sync loop
+        self.event_queue = asyncio.Queue(maxsize=matrixbot.event_queue_size)
+        self.worker = None
+        # the worker is started by MatrixBot once the room is loaded, and
+        # again by the next event after hibernate stopped it
+        self.hibernated = False
+        # if the worker is in the middle of an event
+        self.handling = False
+        # futures of the handler jobs of the last routed event
+        self.last_jobs = []
+        self.last_activity = time.monotonic()
+        self.processed_events = 0
+        self.total_wait_time = 0
+        self.max_wait_time = 0
+        self.last_wait_time = 0
 
 
     async def load_plugins(self):
-        c = self.bot.conn.cursor()
-        r = c.execute("""
+        r = await self.bot.db.fetchall("load_plugins", """
         SELECT pluginname
         FROM rooms JOIN room_plugins ON rooms.roomid == room_plugins.roomid
         WHERE rooms.roomid=?;
         """, (self.room_id,))
 
-        for (pname,) in r.fetchall():
+        for (pname,) in r:
             self.plugins.append(Plugin(self, pname))
 
         # load plugins
@@ -40,11 +59,125 @@ class MatrixRoom():
 
 
     async def handle_text_event(self, event):
-        results = await asyncio.gather(*(p.test_callback(event)
-            for p in self.plugins))
-        await asyncio.gather(*(p.handle_callback(event)
-            for p in compress(self.plugins,results)))
+        # with a room limit of 1 the handlers of a room run one after another
+        # anyway. Waiting for the previous event's handlers lets them change
+        # the router (e.g. !addplugin, !remplugin) before this event is routed
+        if self.bot.scheduler.room_limit == 1 and self.last_jobs:
+            await asyncio.wait(self.last_jobs)
+        # plugins activated here register their handlers before routing,
+        # so the event that triggered the activation is handled as well
+        lazy = self.router.lazy_plugins(event)
+        if lazy:
+            await asyncio.gather(*(p.activate() for p in lazy))
+        ctx = self.router.route(event, self)
+        # the handlers are run by the scheduler, the worker only waits
+        # if the room has too many pending jobs
+        self.last_jobs = []
+        for p in ctx.matches:
+            self.last_jobs.append(await self.bot.scheduler.submit(self.room_id, p.pluginname,
+                    lambda p=p: self.run_plugin_callback(p, ctx)))
+
+    async def run_plugin_callback(self, plugin, ctx):
+        try:
+            await plugin.handle_callback(ctx)
+        except Exception as e:
+            await self.report_exception(e)
+
+
+    async def enqueue_event(self, event):
+        if self.event_queue.full():
+            logging.warning(f"Event queue of {self.room_id} is full, waiting for the worker")
+        self.last_activity = time.monotonic()
+        if self.hibernated:
+            self.hibernated = False
+            self.start_worker()
+        await self.event_queue.put((time.monotonic(), event))
+
+    def start_worker(self):
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.process_events())
+
+    async def stop_worker(self):
+        if self.worker is not None:
+            # reset first, so start_worker can start a new one while waiting
+            worker = self.worker
+            self.worker = None
+            worker.cancel()
+            try:
+                await worker
+            except asyncio.CancelledError:
+                pass
+
+    async def process_events(self):
+        while True:
+            enqueued, event = await self.event_queue.get()
+            self.handling = True
+            wait = time.monotonic() - enqueued
+            self.processed_events += 1
+            self.total_wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+            self.last_wait_time = wait
+            if wait > self.bot.event_queue_wait_warning:
+                logging.warning(f"Event waited {wait:.2f}s in queue of {self.room_id}")
+            try:
+                await self.handle_text_event(event)
+            except Exception as e:
+                await self.report_exception(e)
+            finally:
+                self.handling = False
+                self.event_queue.task_done()
 
+    async def report_exception(self, e):
+        traceback.print_exc()
+        logging.warning(e)
+        try:
+            k = traceback.format_exc()
+            if "ADMIN" in self.bot.environment:
+                admin = self.bot.environment['ADMIN']
+                k += f"\nPlease contact {admin} for bug fixing"
+            else:
+                k += "\nPlease contact the plugin creator"
+            await Plugin.send_text(self, k)
+        except Exception as e:
+            traceback.print_exc()
+            logging.warning(e)
+
+    @property
+    def resident(self):
+        return self.worker is not None or any(p.active for p in self.plugins)
+
+    async def hibernate(self):
+        """
+        Unloads the plugins of an idle room as far as they can be activated
+        again by their commands, and stops the worker. Both come back
+        transparently with the next event.
+        """
+        if not self.idle():
+            return
+        last_activity = self.last_activity
+        results = await asyncio.gather(*(p.deactivate() for p in self.plugins))
+        # events may have arrived while the destructors ran, the worker is
+        # only stopped while it waits for the next one
+        if self.last_activity != last_activity or not self.idle():
+            logging.info(f"Room {self.room_id} became active while hibernating, unloaded {sum(results)} plugins")
+            return
+        self.hibernated = True
+        await self.stop_worker()
+        logging.info(f"Room {self.room_id} hibernated, unloaded {sum(results)} plugins")
+
+    def idle(self):
+        """if no event is queued or handled and no handler job is left"""
+        return self.event_queue.empty() and not self.handling \
+            and all(f.done() for f in self.last_jobs)
+
+    def get_queue_stats(self):
+        return {
+            "depth": self.event_queue.qsize(),
+            "processed": self.processed_events,
+            "avg_wait": self.total_wait_time / self.processed_events if self.processed_events else 0,
+            "max_wait": self.max_wait_time,
+            "last_wait": self.last_wait_time,
+        }
 
     async def introduce_bot(self):
         try:
@@ -66,20 +199,18 @@ class MatrixRoom():
         """
         To be called on entering a new room. Acts as a constructor for MatrixRoom and adds
         the room to the database among introducing itself to the room.
+        nio_room has to be known from a sync already, see MatrixBot.process_invites.
         """
-        c = bot.conn.cursor()
         # this is a "insert if not already exists"
-        r = c.execute("""
+        await bot.db.execute("new_room", """
         INSERT INTO rooms
         SELECT (?)
         WHERE NOT EXISTS (SELECT * FROM rooms
                           WHERE roomid = ?);
         """, (nio_room.room_id,nio_room.room_id,))
-        bot.conn.commit()
 
         room = cls(bot, nio_room)
         await room.load_plugins()
-        await room.bot.client.sync()
         await room.introduce_bot()
         for p in ["help", "meta"]:
             if not any(p == plugin.pluginname for plugin in room.plugins):
@@ -93,29 +224,42 @@ class MatrixRoom():
         if pluginname in [p.pluginname for p in self.plugins]:
             logging.warning(f"{self.room_id} tried to load already loaded plugin {pluginname}")
             return
-        c = self.bot.conn.cursor()
-        r = c.execute("""
-        INSERT INTO room_plugins(roomid,pluginname)
+        # the plugin is added before the first await to prevent race conditions
+        plugin = Plugin(self, pluginname)
+        self.plugins.append(plugin)
+        await self.bot.db.execute("add_plugin", """
+        INSERT OR IGNORE INTO room_plugins(roomid,pluginname)
         VALUES (?,?); 
         """, (self.room_id, pluginname))
-        self.bot.conn.commit()
+        await plugin.load()
 
+    async def reload_plugin(self, pluginname):
+        """
+        Replaces the plugin with a new instance using the reloaded module.
+        Nothing happens if the plugin is not enabled in this room.
+        """
+        indices = [i for (i,p) in enumerate(self.plugins) if p.pluginname==pluginname]
+        if not indices:
+            return
+        old = self.plugins[indices[0]]
+        self.router.remove_plugin(old)
+        await old.stop_all_tasks()
         plugin = Plugin(self, pluginname)
-        self.plugins.append(plugin)
-        # this has to be the last statement to prevent race conditions
+        self.plugins[indices[0]] = plugin
         await plugin.load()
 
     async def remove_plugin(self, pluginname):
-        # no need for lock as only yielding point of control flow is await statement, which is last
-        c = self.bot.conn.cursor()
-        # we put this before the if block to be able to remove plugins that are left by accident
-        r = c.execute("""
-        DELETE FROM room_plugins
-        WHERE roomid=? AND pluginname=?;
-        """, (self.room_id, pluginname))
-        self.bot.conn.commit()
+        # no need for lock as the plugin is removed before the first await
         indices = [i for (i,p) in enumerate(self.plugins) if p.pluginname==pluginname]
+        p = None
         if indices:
             p = self.plugins[indices[0]]
             del self.plugins[indices[0]]
+            self.router.remove_plugin(p)
+        # this is not in the if block to be able to remove plugins that are left by accident
+        await self.bot.db.execute("remove_plugin", """
+        DELETE FROM room_plugins
+        WHERE roomid=? AND pluginname=?;
+        """, (self.room_id, pluginname))
+        if p is not None:
             await p.stop_all_tasks()
@@ -6,10 +6,19 @@ import pathlib
 import shlex
 import traceback
 import re
+import time
+import contextvars
+import contextlib
 
 from itertools import compress
 from pathlib import Path
 
+from kvstore import KVTransaction
+from plugintables import format_sql
+
+# match object of the handler that is currently executed, set per task
+current_match = contextvars.ContextVar("current_match", default=None)
+
 class Plugin:
     def __init__(self, mroom, pluginname):
         self.mroom = mroom
@@ -24,45 +33,108 @@ class Plugin:
 
         self.tasks = set()
 
+        # lazy plugins are only activated on the first matching command
+        self.active = False
+        self.activation_lock = asyncio.Lock()
+        self.lazy_commands = []
+
     async def load(self):
-        filename = self.pluginname + "_plugin.py"
-        full_plugin_path = None
-        for path in self.bot.pluginpath:
-            p = Path(path).resolve()
-            if (p / filename ).exists():
-                full_plugin_path = p / filename
-                break
-        if full_plugin_path is None:
-            logging.warning(f"""
-            Room {self.mroom.room_id}: couldn't load plugin {self.pluginname}: file does not exist
-            """)
-            return False
-
-        logging.info(f"Room {self.nio_room.room_id}: trying to load {full_plugin_path}")
-        modname = f'plugins.{self.pluginname}'
-        loader = importlib.machinery.SourceFileLoader(modname,
-                str(full_plugin_path))
-        try:
-            self.module = loader.load_module(modname)
-            self.module.ENVIRONMENT = self.bot.environment.copy()
-            await self.module.register_to(self)
+        """
+        Plugins declaring their COMMANDS are activated on the first message
+        starting with one of them, unless they set EAGER_LOAD (e.g. because
+        they start timers or register webhooks). All others are activated now.
+        """
+        manifest = self.bot.plugin_manifests.get(self.pluginname, {})
+        if manifest.get("COMMANDS") and not manifest.get("EAGER_LOAD", False):
+            self.lazy_commands = list(manifest["COMMANDS"])
+            self.mroom.router.add_lazy_plugin(self)
+            return True
+        return await self.activate()
+
+    async def activate(self):
+        async with self.activation_lock:
+            if self.active:
+                return True
+            logging.info(f"Room {self.nio_room.room_id}: trying to load {self.pluginname}")
+            try:
+                start = time.monotonic()
+                await self.bot.ensure_global_plugins(
+                        self.bot.plugin_manifests.get(self.pluginname, {}).get("GLOBAL_DEPENDS", []))
+                self.module = self.bot.load_plugin_module(self.pluginname)
+                await self.bot.migrate_plugin_tables(self.pluginname, self.module)
+                await self.module.register_to(self)
+                self.active = True
+                self.bot.profiler.record_register(self.mroom.room_id, self.pluginname, time.monotonic() - start)
+                return True
+            except Exception as e:
+                traceback.print_exc()
+                logging.warning(f"Room {self.mroom.room_id}: couldn't load plugin {self.pluginname}: {e}")
+                self.mroom.router.remove_plugin(self)
+                return False
+            finally:
+                self.mroom.router.remove_lazy_plugin(self)
+
+    async def deactivate(self):
+        """
+        Unloads a lazily activated plugin again, it is activated on its next
+        command. Plugins with running tasks are kept. Returns if the plugin
+        has been deactivated.
+        """
+        async with self.activation_lock:
+            if not self.active or not self.lazy_commands or self.tasks:
+                return False
+            self.mroom.router.remove_plugin(self)
+            # calls the destructor, which has to persist the plugin's state
+            await self.stop_all_tasks()
+            self.handlers = []
+            self.module = None
+            self.active = False
+            self.mroom.router.add_lazy_plugin(self)
             return True
-        except Exception as e:
-            traceback.print_exc()
-            logging.warning(str(e))
-            return False
 
     def add_handler(self, handler):
         self.handlers.append(handler)
+        self.mroom.router.add_handler(self, handler)
 
-    async def test_callback(self, event):
-        self.handler_results = [handler.test_callback(self.mroom, event) for handler in self.handlers]
-        return any(self.handler_results)
-    
-    async def handle_callback(self, event):
-        totrigger = compress(self.handlers,self.handler_results)
-        for handler in totrigger:
-            await handler.handle_callback(self.mroom, event)
+    async def handle_callback(self, ctx):
+        """
+        calls the handlers of this plugin that matched the event of the
+        DispatchContext ctx
+        """
+        for (handler, match) in ctx.matches.get(self, []):
+            token = current_match.set(match)
+            try:
+                await self.run_handler(handler, ctx.event)
+            finally:
+                current_match.reset(token)
+
+    async def run_handler(self, handler, event):
+        """
+        runs a handler within its time budget, overrunning handlers are
+        cancelled and slow ones are logged
+        """
+        timeout = handler.timeout if handler.timeout is not None else self.bot.handler_timeout
+        start = time.monotonic()
+        try:
+            if timeout:
+                await asyncio.wait_for(handler.handle_callback(self.mroom, event), timeout)
+            else:
+                await handler.handle_callback(self.mroom, event)
+        except asyncio.TimeoutError:
+            logging.warning(f"Room {self.mroom.room_id}: {handler.describe()} of plugin {self.pluginname} exceeded its time budget of {timeout}s and was cancelled")
+            await self.send_notice(f"{handler.describe()} took longer than {timeout}s and was cancelled")
+            return
+        duration = time.monotonic() - start
+        if duration > self.bot.handler_slow_threshold:
+            logging.warning(f"Room {self.mroom.room_id}: {handler.describe()} of plugin {self.pluginname} was slow ({duration:.2f}s)")
+
+    @staticmethod
+    def get_match():
+        """
+        returns the match object of the currently running handler, e.g. to
+        reuse the groups captured by the regex of a RegexHandler
+        """
+        return current_match.get()
 
     async def stop_all_tasks(self):
         await asyncio.gather(*(self.stop_task(t) for t in self.tasks))
@@ -72,8 +144,9 @@ class Plugin:
         if hasattr(self.module,"destructor") and callable(self.module.destructor):
             try:
                 await self.module.destructor(self)
-            except:
-                pass
+            except Exception as e:
+                traceback.print_exc()
+                logging.warning(f"Room {self.mroom.room_id}: destructor of {self.pluginname} failed: {e}")
         #self.tasks = set()
 
 
@@ -87,9 +160,17 @@ class Plugin:
         given a regex and a function, the function will be called,
         whenever a message matches the regex
         """
-        def __init__(self, regexstring, handle_callback):
+        def __init__(self, regexstring, handle_callback, timeout=None):
+            """
+            timeout is the time budget of the callback in seconds, after which
+            it is cancelled. None uses the HANDLER_TIMEOUT of the bot, 0 disables it.
+            """
             self.re = re.compile(regexstring)
             self.handle_callback = handle_callback
+            self.timeout = timeout
+
+        def describe(self):
+            return self.re.pattern
 
         def test_callback(self, room, event):
             if event.source['type'] == 'm.room.message':
@@ -100,8 +181,14 @@ class Plugin:
         given a string s and a function, the function will be called,
         whenever !s is written at the start of a message
         """
-        def __init__(self, commandstring, handle_callback):
-            super().__init__(r'^!' + commandstring + '(\s.*)?$', handle_callback)
+        def __init__(self, commandstring, handle_callback, timeout=None):
+            super().__init__(r'^!' + commandstring + '(\s.*)?$', handle_callback, timeout)
+            # plain command words are indexed by the CommandRouter of the room,
+            # anything else is treated like a RegexHandler
+            self.command = commandstring if re.fullmatch(r'[\w-]+', commandstring) else None
+
+        def describe(self):
+            return "!" + (self.command or self.re.pattern)
 
 
     #=============================================
@@ -212,35 +299,27 @@ class Plugin:
     #==============================================
     # only use strings. Use json for conversion
 
+    # writes are committed in groups, see KVStore. Reads see pending writes
+    # values set with a ttl (seconds) are hidden once it's over and deleted later
+
+    def kvstore_scope(self, scope):
+        """returns the table and id columns of the scope "plugin", "room" or "local" """
+        if scope == "plugin":
+            return ("plugin_data", (("pluginname", self.pluginname),))
+        if scope == "room":
+            return ("room_data", (("roomid", self.mroom.room_id),))
+        if scope == "local":
+            return ("room_plugin_data", (("roomid", self.mroom.room_id), ("pluginname", self.pluginname)))
+        raise ValueError(f"unknown key-value store scope {scope}")
+
     async def kvstore_get_plugin_keys(self):
-        c = self.bot.conn.cursor()
-        r = c.execute("""
-        SELECT key
-        FROM plugin_data
-        WHERE pluginname=?;
-        """, (self.pluginname,))
-        k = [k[0] for k in r.fetchall()]
-        return k
+        return await self.bot.kvstore.get_keys(*self.kvstore_scope("plugin"))
 
     async def kvstore_get_room_keys(self):
-        c = self.bot.conn.cursor()
-        r = c.execute("""
-        SELECT key
-        FROM room_data
-        WHERE roomid = ?;
-        """, (self.mroom.room_id,))
-        k = [k[0] for k in r.fetchall()]
-        return k
+        return await self.bot.kvstore.get_keys(*self.kvstore_scope("room"))
 
     async def kvstore_get_local_keys(self):
-        c = self.bot.conn.cursor()
-        r = c.execute("""
-        SELECT key
-        FROM room_plugin_data
-        WHERE roomid = ? AND pluginname=?;
-        """, (self.mroom.room_id, self.pluginname))
-        k = [k[0] for k in r.fetchall()]
-        return k
+        return await self.bot.kvstore.get_keys(*self.kvstore_scope("local"))
 
 
 
@@ -248,62 +327,26 @@ class Plugin:
 
 
     async def kvstore_get_plugin_value(self, key):
-        c = self.bot.conn.cursor()
-        r = c.execute("""
-        SELECT value
-        FROM plugin_data
-        WHERE pluginname=? AND key=?;
-        """, (self.pluginname, key))
-        k = r.fetchall()
-        return k[0][0] if k else None
+        return await self.bot.kvstore.get_value(*self.kvstore_scope("plugin"), key)
 
     async def kvstore_get_room_value(self, key):
-        c = self.bot.conn.cursor()
-        r = c.execute("""
-        SELECT value
-        FROM room_data
-        WHERE roomid=? AND key=?;
-        """, (self.mroom.room_id, key))
-        k = r.fetchall()
-        return k[0][0] if k else None
+        return await self.bot.kvstore.get_value(*self.kvstore_scope("room"), key)
 
     async def kvstore_get_local_value(self, key):
-        c = self.bot.conn.cursor()
-        r = c.execute("""
-        SELECT value
-        FROM room_plugin_data
-        WHERE roomid=? AND pluginname=? AND key=?;
-        """, (self.mroom.room_id, self.pluginname, key))
-        k = r.fetchall()
-        return k[0][0] if k else None
+        return await self.bot.kvstore.get_value(*self.kvstore_scope("local"), key)
 
 
 
 
 
-    async def kvstore_set_plugin_value(self, key, value):
-        c = self.bot.conn.cursor()
-        r = c.execute("""
-        INSERT OR REPLACE INTO plugin_data(pluginname,key,value)
-        VALUES (?,?,?);
-        """, (self.pluginname,key,value))
-        self.bot.conn.commit()
+    async def kvstore_set_plugin_value(self, key, value, ttl=None):
+        self.bot.kvstore.set_value(*self.kvstore_scope("plugin"), key, value, ttl)
     
-    async def kvstore_set_room_value(self, key, value):
-        c = self.bot.conn.cursor()
-        r = c.execute("""
-        INSERT OR REPLACE INTO room_data(roomid,key,value)
-        VALUES (?,?,?);
-        """, (self.mroom.room_id,key,value))
-        self.bot.conn.commit()
+    async def kvstore_set_room_value(self, key, value, ttl=None):
+        self.bot.kvstore.set_value(*self.kvstore_scope("room"), key, value, ttl)
     
-    async def kvstore_set_local_value(self, key, value):
-        c = self.bot.conn.cursor()
-        r = c.execute("""
-        INSERT OR REPLACE INTO room_plugin_data(roomid,pluginname,key,value)
-        VALUES (?,?,?,?);
-        """, (self.mroom.room_id, self.pluginname, key, value))
-        self.bot.conn.commit()
+    async def kvstore_set_local_value(self, key, value, ttl=None):
+        self.bot.kvstore.set_value(*self.kvstore_scope("local"), key, value, ttl)
     
 
 
@@ -311,30 +354,89 @@ class Plugin:
 
 
     async def kvstore_rem_plugin_value(self, key):
-        c = self.bot.conn.cursor()
-        r = c.execute("""
-        DELETE FROM plugin_data
-        WHERE pluginname=? AND key=?;
-        """, (self.pluginname, key))
-        self.bot.conn.commit()
+        self.bot.kvstore.rem_value(*self.kvstore_scope("plugin"), key)
 
     async def kvstore_rem_room_value(self, key):
-        c = self.bot.conn.cursor()
-        r = c.execute("""
-        DELETE FROM room_data
-        WHERE roomid=? AND key=?;
-        """, (self.mroom.room_id, key))
-        self.bot.conn.commit()
+        self.bot.kvstore.rem_value(*self.kvstore_scope("room"), key)
 
     async def kvstore_rem_local_value(self, key):
-        c = self.bot.conn.cursor()
-        r = c.execute("""
-        DELETE FROM room_plugin_data
-        WHERE roomid=? AND pluginname=? AND key=?
-        """, (self.mroom.room_id, self.pluginname, key))
-        self.bot.conn.commit()
+        self.bot.kvstore.rem_value(*self.kvstore_scope("local"), key)
+
+    async def kvstore_get_many(self, keys, scope="local"):
+        """returns a dict key -> value (None if missing) of the scope "plugin", "room" or "local" """
+        return await self.bot.kvstore.get_many(*self.kvstore_scope(scope), keys)
+
+    async def kvstore_set_many(self, mapping, scope="local", ttl=None):
+        """sets all values of the dict mapping, they are committed together"""
+        self.bot.kvstore.set_many(*self.kvstore_scope(scope), mapping, ttl)
+
+    def kvstore_scan(self, prefix="", start=None, end=None, scope="local"):
+        """
+        async for (key, value) in plugin.kvstore_scan(prefix="user:"):
+        iterates over the keys with the prefix and in [start, end) in key
+        order, reading them page by page
+        """
+        return self.bot.kvstore.scan(*self.kvstore_scope(scope), prefix, start, end)
+
+    @contextlib.asynccontextmanager
+    async def kvstore_transaction(self, scope="local"):
+        """
+        async with plugin.kvstore_transaction() as t:
+            ... await t.get_value(key), await t.set_value(key, value), ...
+        The writes are committed together when the block is left, and
+        discarded if it raises an exception. Transactions on the same scope
+        run one after another, don't nest them.
+        """
+        async with self.bot.kvstore.lock(*self.kvstore_scope(scope)):
+            transaction = KVTransaction(self.bot.kvstore, *self.kvstore_scope(scope))
+            yield transaction
+            # the writes are visible to reads from here on, the next
+            # transaction doesn't need to wait for the commit
+            committed = transaction.commit()
+        await committed
+
+    async def kvstore_flush(self):
+        """commits all pending writes, for callers that need them to be durable"""
+        await self.bot.kvstore.flush()
         
 
+    #=============================================
+    # Plugin helper functions (own tables)
+    #==============================================
+    # the tables are declared in MIGRATIONS, see PLUGINS.md. In the sql
+    # {name} refers to the plugin's table name and :roomid to the room
+
+    def db_params(self, params):
+        return dict(params or {}, roomid=self.mroom.room_id)
+
+    async def db_fetchall(self, sql, params=None):
+        return await self.bot.db.fetchall(f"plugin_{self.pluginname}",
+                format_sql(self.pluginname, sql), self.db_params(params))
+
+    async def db_execute(self, sql, params=None):
+        await self.bot.db.execute(f"plugin_{self.pluginname}",
+                format_sql(self.pluginname, sql), self.db_params(params))
+
+    async def db_executemany(self, sql, seq_of_params):
+        await self.bot.db.executemany(f"plugin_{self.pluginname}",
+                format_sql(self.pluginname, sql), [self.db_params(p) for p in seq_of_params])
+
+    async def db_execute_batch(self, statements):
+        """executes a list of (sql, params) in one transaction"""
+        statements = [(format_sql(self.pluginname, sql), self.db_params(params))
+                      for (sql, params) in statements]
+
+        def execute_batch(conn):
+            try:
+                for (sql, params) in statements:
+                    conn.execute(sql, params)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+        await self.bot.db.run(f"plugin_{self.pluginname}", execute_batch)
+
     #=============================================
     # Plugin helper functions (http_server)
     #==============================================
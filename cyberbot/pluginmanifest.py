@@ -0,0 +1,75 @@
+import ast
+import json
+import logging
+import os
+
+# module-level variables of a plugin that are read without executing it
+MANIFEST_FIELDS = ["HELP_DESC", "COMMANDS", "EAGER_LOAD", "GLOBAL_DEPENDS"]
+
+
+def read_manifest(path):
+    """
+    Returns the MANIFEST_FIELDS a plugin file assigns literal values to,
+    by parsing the file instead of importing it. Fields assigned anything
+    else than a literal (e.g. a computed string) are left out.
+    """
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), str(path))
+    manifest = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) \
+                and len(node.targets) == 1 \
+                and isinstance(node.targets[0], ast.Name) \
+                and node.targets[0].id in MANIFEST_FIELDS:
+            try:
+                manifest[node.targets[0].id] = ast.literal_eval(node.value)
+            except ValueError:
+                pass
+    return manifest
+
+
+class ManifestCache:
+    """
+    Caches the manifests of plugin files on disk, keyed by path and mtime,
+    so unchanged plugins are not even parsed on startup.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                logging.warning(f"Ignoring broken plugin manifest cache {path}: {e}")
+
+    def get(self, plugin_path):
+        key = str(plugin_path)
+        mtime = os.stat(plugin_path).st_mtime
+        entry = self.entries.get(key)
+        if entry is not None and entry["mtime"] == mtime \
+                and entry.get("fields") == MANIFEST_FIELDS:
+            return entry["manifest"]
+        manifest = read_manifest(plugin_path)
+        self.set(plugin_path, manifest)
+        return manifest
+
+    def set(self, plugin_path, manifest):
+        self.entries[str(plugin_path)] = {
+            "mtime": os.stat(plugin_path).st_mtime,
+            "fields": MANIFEST_FIELDS,
+            "manifest": manifest,
+        }
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            with open(self.path, "w") as f:
+                json.dump(self.entries, f)
+            self.dirty = False
+        except Exception as e:
+            logging.warning(f"Couldn't write plugin manifest cache {self.path}: {e}")
@@ -0,0 +1,56 @@
+import logging
+
+
+class TableNames(dict):
+    """
+    Maps the table names a plugin uses in its sql, e.g. "{polls}", to
+    names in the plugin's own namespace, e.g. "plugin_voting_polls".
+    """
+
+    def __init__(self, pluginname):
+        super().__init__()
+        self.pluginname = pluginname
+
+    def __missing__(self, name):
+        return f"plugin_{self.pluginname}_{name}"
+
+
+def format_sql(pluginname, sql):
+    return sql.format_map(TableNames(pluginname))
+
+
+def migrate(conn, pluginname, migrations):
+    """
+    Brings the tables of a plugin to the newest version of its MIGRATIONS.
+    Every migration is a list of sql statements and functions f(conn, tables),
+    the migrations newer than the stored version of the plugin's schema are
+    run in one transaction. Runs on the database thread.
+    """
+    r = conn.execute("""
+    SELECT version
+    FROM plugin_schemas
+    WHERE pluginname=?;
+    """, (pluginname,)).fetchall()
+    version = r[0][0] if r else 0
+    if version >= len(migrations):
+        return version
+
+    tables = TableNames(pluginname)
+    conn.execute("BEGIN;")
+    try:
+        for steps in migrations[version:]:
+            for step in steps:
+                if callable(step):
+                    step(conn, tables)
+                else:
+                    conn.execute(step.format_map(tables))
+        conn.execute("""
+        INSERT OR REPLACE INTO plugin_schemas(pluginname, version)
+        VALUES (?,?);
+        """, (pluginname, len(migrations)))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    logging.info(f"Migrated the tables of plugin {pluginname} from version {version} to {len(migrations)}")
+    return len(migrations)
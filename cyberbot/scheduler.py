@@ -0,0 +1,128 @@
+import asyncio
+import logging
+
+from collections import defaultdict, deque
+
+
+class FairScheduler:
+    """
+    Runs the plugin handlers of all rooms with a fair share of the event loop.
+
+    Jobs are queued per room and started round-robin across rooms, as long
+    as the global, the per-room and the per-plugin concurrency limits allow
+    it. Jobs over quota stay queued until a slot is free. With a room limit
+    of 1 the jobs of a room are run one after another in submission order.
+    """
+
+    def __init__(self, max_concurrent, room_limit, plugin_limit, room_backlog):
+        self.max_concurrent = max_concurrent
+        self.room_limit = room_limit
+        self.plugin_limit = plugin_limit
+        self.room_backlog = room_backlog
+
+        # room_id -> deque of (pluginname, job, future)
+        self.pending = {}
+        # room_ids with pending jobs in round-robin order
+        self.ready = deque()
+        # room_id -> semaphore limiting the number of pending jobs
+        self.backlog = {}
+
+        # references to the running job tasks
+        self.tasks = set()
+        self.running = 0
+        self.running_rooms = defaultdict(int)
+        self.running_plugins = defaultdict(int)
+
+    async def submit(self, room_id, pluginname, job):
+        """
+        queues the coroutine function job and returns a future for its result.
+        Waits while the room already has room_backlog pending jobs.
+        """
+        if room_id not in self.backlog:
+            self.backlog[room_id] = asyncio.Semaphore(self.room_backlog)
+        await self.backlog[room_id].acquire()
+
+        future = asyncio.get_event_loop().create_future()
+        if room_id not in self.pending:
+            self.pending[room_id] = deque()
+            self.ready.append(room_id)
+        self.pending[room_id].append((pluginname, job, future))
+        self._dispatch()
+        return future
+
+    def cancel_room(self, room_id):
+        """drops all pending jobs of a room, running jobs are not affected"""
+        for (pluginname, job, future) in self.pending.pop(room_id, []):
+            future.cancel()
+        if room_id in self.ready:
+            self.ready.remove(room_id)
+        self.backlog.pop(room_id, None)
+
+    def _take_job(self, room_id):
+        if self.running_rooms.get(room_id, 0) >= self.room_limit:
+            return None
+        jobs = self.pending[room_id]
+        # with a room limit of 1 the jobs of a room keep their order, a job
+        # whose plugin is at its limit blocks the ones behind it
+        candidates = 1 if self.room_limit == 1 else len(jobs)
+        for i in range(candidates):
+            (pluginname, job, future) = jobs[i]
+            if self.running_plugins.get(pluginname, 0) < self.plugin_limit:
+                del jobs[i]
+                return (pluginname, job, future)
+        return None
+
+    def _dispatch(self):
+        idle = 0
+        while self.ready and idle < len(self.ready) and self.running < self.max_concurrent:
+            room_id = self.ready.popleft()
+            taken = self._take_job(room_id)
+            if self.pending[room_id]:
+                self.ready.append(room_id)
+            else:
+                del self.pending[room_id]
+            if taken is None:
+                idle += 1
+            else:
+                idle = 0
+                self.backlog[room_id].release()
+                self._start(room_id, *taken)
+
+    def _start(self, room_id, pluginname, job, future):
+        self.running += 1
+        self.running_rooms[room_id] += 1
+        self.running_plugins[pluginname] += 1
+
+        async def run():
+            try:
+                result = await job()
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                logging.warning(f"Job of {pluginname} in {room_id} failed: {e}")
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.running -= 1
+                self.running_rooms[room_id] -= 1
+                if not self.running_rooms[room_id]:
+                    del self.running_rooms[room_id]
+                self.running_plugins[pluginname] -= 1
+                if not self.running_plugins[pluginname]:
+                    del self.running_plugins[pluginname]
+                self._dispatch()
+
+        t = asyncio.create_task(run())
+        self.tasks.add(t)
+        t.add_done_callback(self.tasks.discard)
+
+    def get_stats(self):
+        return {
+            "running": self.running,
+            "pending": sum(len(jobs) for jobs in self.pending.values()),
+            "running_rooms": dict(self.running_rooms),
+            "running_plugins": dict(self.running_plugins),
+        }
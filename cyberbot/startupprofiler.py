@@ -0,0 +1,90 @@
+import json
+import logging
+import time
+
+from contextlib import contextmanager
+
+
+class StartupProfiler:
+    """
+    Records the wall time of the startup phases of the bot, of every global
+    plugin and of every room and register_to call, until finish is called.
+    The size of the initial syncs is recorded as well.
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.finished = False
+        # phase name -> seconds, in the order the phases ended
+        self.phases = {}
+        # global plugin name -> seconds
+        self.global_plugins = {}
+        # room_id -> {"total": seconds, "plugins": {pluginname: seconds}}
+        self.rooms = {}
+        # one entry per initial sync request, see record_sync
+        self.syncs = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.monotonic() - start
+
+    def record_global_plugin(self, name, seconds):
+        self.global_plugins[name] = seconds
+
+    def record_sync(self, kind, seconds, response):
+        """records how long a sync took and how many events it returned"""
+        rooms = getattr(getattr(response, "rooms", None), "join", {})
+        self.syncs.append({
+            "kind": kind,
+            "seconds": seconds,
+            "rooms": len(rooms),
+            "state_events": sum(len(r.state) for r in rooms.values()),
+            "timeline_events": sum(len(r.timeline.events) for r in rooms.values()),
+        })
+
+    def record_room(self, room_id, seconds):
+        if not self.finished:
+            self.rooms.setdefault(room_id, {"plugins": {}})["total"] = seconds
+
+    def record_register(self, room_id, pluginname, seconds):
+        if not self.finished:
+            self.rooms.setdefault(room_id, {"plugins": {}})["plugins"][pluginname] = seconds
+
+    def report(self):
+        return {
+            "total": self.total,
+            "phases": self.phases,
+            "global_plugins": self.global_plugins,
+            "syncs": self.syncs,
+            "rooms": self.rooms,
+        }
+
+    def finish(self, report_path=None):
+        """logs a summary and writes the full report as json to report_path"""
+        self.total = time.monotonic() - self.start
+        self.finished = True
+
+        summary = f"Startup took {self.total:.2f}s"
+        for (name, seconds) in self.phases.items():
+            summary += f"\n  {name:24} {seconds:8.2f}s"
+        for sync in self.syncs:
+            summary += (f"\n  {sync['kind']} sync {sync['seconds']:8.2f}s, {sync['rooms']} rooms,"
+                        f" {sync['state_events']} state and {sync['timeline_events']} timeline events")
+        for (name, seconds) in self.global_plugins.items():
+            summary += f"\n  global plugin {name:10} {seconds:8.2f}s"
+        slowest = sorted(((room["total"], room_id) for (room_id, room) in self.rooms.items()
+                          if "total" in room), reverse=True)[:5]
+        for (seconds, room_id) in slowest:
+            summary += f"\n  room {room_id} {seconds:8.2f}s"
+        logging.info(summary)
+
+        if report_path:
+            try:
+                with open(report_path, "w") as f:
+                    json.dump(self.report(), f, indent=2)
+            except Exception as e:
+                logging.warning(f"Couldn't write startup report to {report_path}: {e}")
@@ -13,6 +13,9 @@ from aiohttp import web
 
 from matrixroom import MatrixRoom
 
+# global plugins that have to be started before this one
+DEPENDS = ["http_server"]
+
 class GitHubManager:
     def __init__(self):
         self.tokens = defaultdict(list)
@@ -78,7 +81,9 @@ class GitHubManager:
             for token in self.tokens:
                 h = hmac.new(bytes(token, encoding="utf8"), c, "sha256")
                 if (hmac.compare_digest(h.hexdigest(), sig)):
-                    handlers = [handler for (hid, handler) in self.tokens[token]]
+                    # only notify rooms the bot is still active in
+                    handlers = [handler for (hid, handler) in self.tokens[token]
+                                if self.bot.get_room(handler.plugin.mroom.room_id) is not None]
                     try:
                         content = json.loads(c.decode("utf-8"))
                     except Exception as e:
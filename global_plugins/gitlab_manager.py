@@ -12,6 +12,9 @@ from aiohttp import web
 
 from matrixroom import MatrixRoom
 
+# global plugins that have to be started before this one
+DEPENDS = ["http_server"]
+
 class GitLabManager:
     def __init__(self):
         self.tokens = defaultdict(list)
@@ -62,7 +65,9 @@ class GitLabManager:
                 return web.Response(status=400)
 
             if token in self.tokens:
-                handlers = [handler for (hid, handler) in self.tokens[token]]
+                # only notify rooms the bot is still active in
+                handlers = [handler for (hid, handler) in self.tokens[token]
+                            if self.bot.get_room(handler.plugin.mroom.room_id) is not None]
                 c = await request.content.read()
                 with open("hookslog.txt", "ab+") as f:
                     f.write(c)
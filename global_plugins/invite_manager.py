@@ -3,6 +3,9 @@ import asyncio
 import nio
 from aiohttp import web
 
+# global plugins that have to be started before this one
+DEPENDS = ["http_server"]
+
 class InviteManager:
 
     def __init__(self):
@@ -48,12 +51,12 @@ class InviteManager:
             if (token not in self.invitations.keys()):
                 return web.Response(text=gen_html("Invalid Link"), content_type='text/html')
             room_id, invitor = self.invitations[token]
-            room = self.bot.client.rooms.get(room_id)
+            room = self.bot.get_room(room_id)
             if request.method == "GET":
                 if room is None:
                     room_name = "Unknown Room (Probably will fail to join)"
                 else:
-                    room_name = room.display_name
+                    room_name = room.nio_room.display_name
                 content = gen_site_content(room_name, invitor)
                 return web.Response(text=content, content_type='text/html')
             elif request.method == "POST":
@@ -1,5 +1,6 @@
 
 HELP_DESC = ("!help\t\t\t-\tDisplay this help message\n")
+COMMANDS = ["help"]
 
 async def register_to(plugin):
     def format_help(text):
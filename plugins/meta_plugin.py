@@ -5,6 +5,7 @@ HELP_DESC = ("""
 !addplugin plugin [plugin2 ...]\t-\tadd plugin(s) (--all for all)
 !remplugin plugin [plugin2 ...]\t-\tremove plugin(s)
 """)
+COMMANDS = ["listplugins", "addplugin", "remplugin"]
 
 
 blacklisted = ["help" "meta"]
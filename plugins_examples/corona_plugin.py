@@ -3,6 +3,7 @@ import requests
 
 
 HELP_DESC = ("!corona\t\t\t-\tShow Coronavirus stats\n")
+COMMANDS = ["corona"]
 
 def get_stats():
     url = "https://rki-covid-api.now.sh/api/states"
@@ -4,20 +4,55 @@ HELP_DESC = ("""!doing <TASKNAME>\t\t\t-\tTell people that you are doing a speci
 !finished <TASKNAME>\t\t-\tMark task as solved/finished and remove from task list
 !cleardoing\t\t-\tClear current task mapping
 """)
-
+COMMANDS = ["doing", "done", "finished", "cleardoing"]
+
+
+def migrate_json_mapping(conn, tables):
+    """moves the task mappings of all rooms from the json blob in the key-value store to the table"""
+    rows = conn.execute("""
+    SELECT roomid, value
+    FROM room_plugin_data
+    WHERE pluginname='ctf' AND key='mapping';
+    """).fetchall()
+    for (roomid, value) in rows:
+        conn.executemany(f"""
+        INSERT OR IGNORE INTO {tables["doing"]}(roomid, task, user)
+        VALUES (?,?,?);
+        """, [(roomid, task, user) for (task, users) in json.loads(value).items() for user in users])
+    conn.execute("""
+    DELETE FROM room_plugin_data
+    WHERE pluginname='ctf' AND key='mapping';
+    """)
+
+# one row per user and task instead of rewriting the whole mapping
+MIGRATIONS = [
+    [
+        """
+        CREATE TABLE {doing} (
+            roomid     VARCHAR,
+            task       VARCHAR,
+            user       VARCHAR,
+            PRIMARY KEY (roomid, task, user)
+        );
+        """,
+        migrate_json_mapping,
+    ],
+]
 
 
 async def register_to(plugin):
     mapping = {}
 
-    async def save_mapping():
-        nonlocal mapping
-        await plugin.kvstore_set_local_value("mapping", json.dumps(mapping))
-
     async def load_mapping():
         nonlocal mapping
-        if "mapping" in (await plugin.kvstore_get_local_keys()):
-            mapping = json.loads(await plugin.kvstore_get_local_value("mapping"))
+        mapping = {}
+        for (task, user) in await plugin.db_fetchall("""
+        SELECT task, user
+        FROM {doing}
+        WHERE roomid=:roomid
+        ORDER BY rowid;
+        """):
+            mapping.setdefault(task, []).append(user)
 
     def format_block(text):
         return f"<pre><code>{text}</pre></code>"
@@ -62,13 +97,16 @@ async def register_to(plugin):
             mapping[arg] = [event.source['sender']]
         elif event.source['sender'] not in mapping[arg]:
             mapping[arg].append(event.source['sender'])
-        await save_mapping()
+        await plugin.db_execute("""
+        INSERT OR IGNORE INTO {doing}(roomid, task, user)
+        VALUES (:roomid, :task, :user);
+        """, {"task": arg, "user": event.source['sender']})
         await print_mapping()
 
     async def cleardoing_callback(room, event):
         nonlocal mapping
         mapping = {}
-        await save_mapping()
+        await plugin.db_execute("DELETE FROM {doing} WHERE roomid=:roomid;")
         await print_mapping()
 
     async def done_callback(room, event):
@@ -81,8 +119,11 @@ async def register_to(plugin):
                 mapping[arg].remove(sender_id)
                 if len(mapping[arg]) == 0:
                     mapping.pop(arg)
+                await plugin.db_execute("""
+                DELETE FROM {doing}
+                WHERE roomid=:roomid AND task=:task AND user=:user;
+                """, {"task": arg, "user": sender_id})
 
-        await save_mapping()
         await print_mapping()
 
     async def finished_callback(room, event):
@@ -91,8 +132,11 @@ async def register_to(plugin):
 
         if (arg in mapping):
             mapping.pop(arg)
+            await plugin.db_execute("""
+            DELETE FROM {doing}
+            WHERE roomid=:roomid AND task=:task;
+            """, {"task": arg})
 
-        await save_mapping()
         await print_mapping()
 
     await load_mapping()
@@ -1,4 +1,5 @@
 HELP_DESC = ("!echo\t\t\t-\tEcho back the given string\n")
+COMMANDS = ["echo"]
 
 async def register_to(plugin):
 
@@ -13,6 +13,10 @@ import github.formatting as fmt
 
 
 HELP_DESC = ("!github\t\t\t-\tGithub Webhook Manager/Notifier 🐱\n")
+COMMANDS = ["github"]
+# registers its webhook tokens on load
+EAGER_LOAD = True
+GLOBAL_DEPENDS = ["github_manager"]
 
 DEFAULTCONFIG = {
     "emoji": True,
@@ -57,6 +61,11 @@ class LocalHookManager:
         if store:
             await self.store_tokens()
 
+    async def deregister_tokens(self):
+        """deregisters all tokens from the GitHubManager, they stay stored"""
+        for (tokenid, token) in self.tokens.items():
+            await self.ghm.deregister_hook(token, tokenid)
+
     async def rem_token(self, tokenid):
         if tokenid in self.tokens:
             token = self.tokens[tokenid]
@@ -92,9 +101,14 @@ class LocalHookManager:
         # await self.plugin.send_html(text)
 
 
+# plugin -> LocalHookManager, to deregister its tokens in the destructor
+hook_managers = {}
+
+
 async def destructor(plugin):
-    self.ghm.tokens = defaultdict(list)
-    self.ghm.currenthid = 0
+    lhm = hook_managers.pop(plugin, None)
+    if lhm is not None:
+        await lhm.deregister_tokens()
 
 
 async def register_to(plugin):
@@ -116,6 +130,7 @@ See <a href="https://docs.github.com/en/developers/webhooks-and-events/about-web
 """
 
     lhm = LocalHookManager(plugin)
+    hook_managers[plugin] = lhm
     await lhm.load_tokens()
 
     def format_help(text):
@@ -13,6 +13,10 @@ import gitlab.formatting as fmt
 
 
 HELP_DESC = ("!gitlab\t\t\t-\tGitlab Webhook Manager/Notifier 🦊\n")
+COMMANDS = ["gitlab"]
+# registers its webhook tokens on load
+EAGER_LOAD = True
+GLOBAL_DEPENDS = ["gitlab_manager"]
 
 DEFAULTCONFIG = {
     "emoji": True,
@@ -57,6 +61,11 @@ class LocalHookManager:
         if store:
             await self.store_tokens()
 
+    async def deregister_tokens(self):
+        """deregisters all tokens from the GitLabManager, they stay stored"""
+        for (tokenid, token) in self.tokens.items():
+            await self.glm.deregister_hook(token, tokenid)
+
     async def rem_token(self, tokenid):
         if tokenid in self.tokens:
             token = self.tokens[tokenid]
@@ -92,9 +101,14 @@ class LocalHookManager:
         # await self.plugin.send_html(text)
 
 
+# plugin -> LocalHookManager, to deregister its tokens in the destructor
+hook_managers = {}
+
+
 async def destructor(plugin):
-    self.glm.tokens = defaultdict(list)
-    self.glm.currenthid = 0
+    lhm = hook_managers.pop(plugin, None)
+    if lhm is not None:
+        await lhm.deregister_tokens()
 
 
 async def register_to(plugin):
@@ -116,6 +130,7 @@ See <a href="https://docs.gitlab.com/ee/user/project/integrations/webhooks.html"
 """
 
     lhm = LocalHookManager(plugin)
+    hook_managers[plugin] = lhm
     await lhm.load_tokens()
 
     def format_help(text):
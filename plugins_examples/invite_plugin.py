@@ -5,6 +5,10 @@ import string
 from collections import defaultdict
 
 HELP_DESC = ("!invite\t\t\t-\tGenerate invitation link for current room. Will direct to a website where people can enter their user_id and be invited by the bot.\n")
+COMMANDS = ["invite"]
+# registers its invitation links on load
+EAGER_LOAD = True
+GLOBAL_DEPENDS = ["invite_manager"]
 
 class LocalInviteManager:
     def __init__(self, plugin):
@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 
 HELP_DESC = ("(automatic)\t\t\t-\tEcho a sent request\n")
+GLOBAL_DEPENDS = ["http_server"]
+
+
+def hook_path(plugin):
+    return "room-" + plugin.mroom.room_id
+
+
+async def destructor(plugin):
+    await plugin.http_deregister_path(hook_path(plugin))
+
 
 async def register_to(plugin):
     async def echo(request):
         await plugin.send_text(await request.text())
 
-    path = "room-" + plugin.mroom.room_id
-    res = await plugin.http_register_path(path, echo) 
+    res = await plugin.http_register_path(hook_path(plugin), echo)
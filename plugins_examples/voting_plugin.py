@@ -5,6 +5,63 @@ import time
 from datetime import datetime
 
 HELP_DESC = ("!voting\t\t\t-\tVoting subcommands\n")
+COMMANDS = ["voting"]
+# restarts the timers of running polls on load
+EAGER_LOAD = True
+
+
+def migrate_json_polls(conn, tables):
+    """moves the polls of all rooms from the json blob in the key-value store to the tables"""
+    rows = conn.execute("""
+    SELECT roomid, value
+    FROM room_plugin_data
+    WHERE pluginname='voting' AND key='active_polls';
+    """).fetchall()
+    for (roomid, value) in rows:
+        for (name, creator, duration, voted, options, votes, creation) in json.loads(value):
+            conn.execute(f"""
+            INSERT OR IGNORE INTO {tables["polls"]}(roomid, name, creator, duration, options, creation)
+            VALUES (?,?,?,?,?,?);
+            """, (roomid, name, creator, None if duration == "None" else int(duration),
+                  json.dumps(options), creation))
+            # the blob only has the number of votes per option, not who voted
+            # what, so the voters are assigned to options matching the numbers
+            voted_options = [o for (o, n) in zip(options, votes) for i in range(n)]
+            conn.executemany(f"""
+            INSERT OR IGNORE INTO {tables["votes"]}(roomid, poll, user, option)
+            VALUES (?,?,?,?);
+            """, [(roomid, name, user, option) for (user, option) in zip(voted, voted_options)])
+    conn.execute("""
+    DELETE FROM room_plugin_data
+    WHERE pluginname='voting' AND key='active_polls';
+    """)
+
+# a vote is a single row instead of rewriting all polls
+MIGRATIONS = [
+    [
+        """
+        CREATE TABLE {polls} (
+            roomid     VARCHAR,
+            name       VARCHAR,
+            creator    VARCHAR,
+            duration   INTEGER,
+            options    TEXT,
+            creation   INTEGER,
+            PRIMARY KEY (roomid, name)
+        );
+        """,
+        """
+        CREATE TABLE {votes} (
+            roomid     VARCHAR,
+            poll       VARCHAR,
+            user       VARCHAR,
+            option     VARCHAR,
+            PRIMARY KEY (roomid, poll, user)
+        );
+        """,
+        migrate_json_polls,
+    ],
+]
 
 
 
@@ -27,8 +84,8 @@ async def register_to(plugin):
                 name,
                 options,
                 duration=None,
-                votes=defaultdict(int),
-                voted=[],
+                votes=None,
+                voted=None,
                 creation=None,
                 voting=None):
             self.creator = creator
@@ -42,15 +99,21 @@ async def register_to(plugin):
             else:
                 self.creation = creation
 
-            self.voted = voted
-            self.votes = votes
+            self.voted = voted if voted is not None else []
+            self.votes = votes if votes is not None else defaultdict(int)
             self.task = None
+            # set when the poll is closed by its deadline or !closepoll
+            self.closing = False
 
 
         async def add_vote(self, user, option):
             if option in self.options and user not in self.voted:
                 self.votes[option] += 1;
                 self.voted.append(user)
+                await plugin.db_execute("""
+                INSERT OR IGNORE INTO {votes}(roomid, poll, user, option)
+                VALUES (:roomid, :poll, :user, :option);
+                """, {"poll": self.name, "user": user, "option": option})
                 return True
             else:
                 return False
@@ -72,22 +135,28 @@ async def register_to(plugin):
             return res
 
 
-        def to_list(self):
-            votes = [self.votes[o] for o in self.options]
-            return [self.name,self.creator,str(self.duration),self.voted,self.options,votes, self.creation]
+        async def insert(self):
+            await plugin.db_execute("""
+            INSERT INTO {polls}(roomid, name, creator, duration, options, creation)
+            VALUES (:roomid, :name, :creator, :duration, :options, :creation);
+            """, {"name": self.name, "creator": self.creator, "duration": self.duration,
+                  "options": json.dumps(self.options), "creation": self.creation})
 
+        async def delete(self):
+            await plugin.db_execute_batch([
+                ("DELETE FROM {votes} WHERE roomid=:roomid AND poll=:poll;", {"poll": self.name}),
+                ("DELETE FROM {polls} WHERE roomid=:roomid AND name=:poll;", {"poll": self.name}),
+            ])
 
-        async def from_list(l):
-            print(l)
-            name,creator,duration,voted,options,votes,creation = l
+
+        async def from_row(row, votes):
+            name,creator,duration,options,creation = row
             vs = defaultdict(int)
-            if duration == "None":
-                duration = None
-            else:
-                duration = int(duration)
-            for (o,v) in zip(options,votes):
-                vs[o] = v
-            p = Poll(creator, name, options, duration, vs, voted, creation)
+            voted = []
+            for (user, option) in votes:
+                vs[option] += 1
+                voted.append(user)
+            p = Poll(creator, name, json.loads(options), duration, vs, voted, creation)
             if p.duration is not None:
                 await p.start_timer()
             return p
@@ -97,9 +166,11 @@ async def register_to(plugin):
 
             async def cleanup():
                 print("In clenaup")
+                # the task is also cancelled when the plugin is unloaded,
+                # e.g. removed or reloaded. The poll stays open then
+                if not self.closing:
+                    return
                 await self.voting.close_poll(self.name)
-                print("Save")
-                await self.voting.save()
                 if self.creation + self.duration <= int(time.time()):
                     t = f"Poll Deadline\n"
                 else:
@@ -112,6 +183,7 @@ async def register_to(plugin):
                 if self.creation + self.duration <= int(time.time()):
                     if self.task is not None:
                         print("Triggering cancel")
+                        self.closing = True
                         self.task.cancel()
                         self.task = None
                     else:
@@ -125,35 +197,41 @@ async def register_to(plugin):
 
     class Voting:
 
-        def __init__(self, active_polls=[], onlyadmincreators=False):
-            self.active_polls = active_polls
+        def __init__(self, active_polls=None, onlyadmincreators=False):
+            self.active_polls = active_polls if active_polls is not None else []
             for poll in self.active_polls:
                 poll.voting = self
             self.onlyadmincreators = onlyadmincreators
 
         @classmethod
         async def load(cls):
-            keys = await plugin.kvstore_get_local_keys()
-
-            if "active_polls" not in keys:
-                active_polls = []
-            else:
-                j = json.loads(await plugin.kvstore_get_local_value("active_polls"))
-                active_polls = [await Poll.from_list(l) for l in j]
-
-            if "onlyadmincreators" not in keys:
+            votes = defaultdict(list)
+            for (poll, user, option) in await plugin.db_fetchall("""
+            SELECT poll, user, option
+            FROM {votes}
+            WHERE roomid=:roomid
+            ORDER BY rowid;
+            """):
+                votes[poll].append((user, option))
+            active_polls = [await Poll.from_row(row, votes[row[0]]) for row in await plugin.db_fetchall("""
+            SELECT name, creator, duration, options, creation
+            FROM {polls}
+            WHERE roomid=:roomid
+            ORDER BY rowid;
+            """)]
+
+            onlyadmincreators = await plugin.kvstore_get_local_value("onlyadmincreators")
+            if onlyadmincreators is None:
                 onlyadmincreators = False
             else:
-                onlyadmincreators = bool(await plugin.kvstore_get_local_value("onlyadmincreators"))
+                onlyadmincreators = bool(onlyadmincreators)
 
             v = Voting(active_polls,onlyadmincreators)
             return v
 
 
         async def save(self):
-            active_polls = [poll.to_list() for poll in self.active_polls]
-            j = json.dumps(active_polls)
-            await plugin.kvstore_set_local_value("active_polls", j)
+            # the polls and votes are written to the tables as they change
             await plugin.kvstore_set_local_value("onlyadmincreators", str(self.onlyadmincreators))
 
 
@@ -161,9 +239,10 @@ async def register_to(plugin):
             if any(poll.name == name for poll in self.active_polls):
                 return None
             p = Poll(creator,name,options,duration,voting=self)
+            self.active_polls.append(p)
+            await p.insert()
             if duration is not None:
                 await p.start_timer()
-            self.active_polls.append(p)
             return p
 
 
@@ -180,9 +259,11 @@ async def register_to(plugin):
                 return None
             else:
                 i,poll = p
+                poll.closing = True
                 if poll.task is not None:
                     poll.task.cancel()
                 del self.active_polls[i]
+                await poll.delete()
                 return poll
 
 
@@ -254,7 +335,6 @@ async def register_to(plugin):
                 else:
                     poll = await voting.add_poll(event.sender, name, options, duration)
                     if poll:
-                        await voting.save()
                         await plugin.send_text(f"Sucessfully created poll:\n{poll}")
                     else:
                         await plugin.send_text("There was an error creating the poll.")
@@ -268,7 +348,6 @@ async def register_to(plugin):
                 if p:
                     if p.duration is None:
                         await plugin.send_text(f"Results\n=====================\n{p}")
-                    await voting.save()
                 else:
                     pass
 
@@ -279,12 +358,11 @@ async def register_to(plugin):
             option = args[2]
             if not await voting.vote(name, option, event.sender):
                 plugin.send_text("Error. Check that you haven't voted already and that the poll exists")
-            await voting.save()
 
 
 
 
-    global voting
+    # per room, the callbacks above refer to it via the closure
     voting = await Voting.load()
     # Add a command handler waiting for the echo command
     voting_handler = plugin.CommandHandler("voting", voting_callback)
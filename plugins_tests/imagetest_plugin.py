@@ -2,6 +2,7 @@ import os
 import random
 
 HELP_DESC = ("!imagetest\t\t-\tSend back test image\n")
+COMMANDS = ["imagetest"]
 
 async def register_to(plugin):
 
@@ -14,6 +14,7 @@ HELP_DESC = ("""
 !getroomkeys
 !getpluginkeys
 """[1:-1])
+COMMANDS = ["addlocalval", "addroomval", "addpluginval", "getlocalval", "getroomval", "getpluginval", "remlocalval", "remroomval", "rempluginval", "getlocalkeys", "getroomkeys", "getpluginkeys"]
 
 
 async def register_to(plugin):
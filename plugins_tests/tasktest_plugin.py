@@ -4,14 +4,15 @@ HELP_DESC = ("""
 !startecho text
 !stopecho
 """)
+COMMANDS = ["startecho", "stopecho"]
 
 
-cur_task = None
 async def register_to(plugin):
-
+    # per room, the module is shared by all rooms
+    cur_task = None
 
     async def startecho_callback(room, event):
-        global cur_task
+        nonlocal cur_task
         args = plugin.extract_args(event)
         if cur_task is None and len(args) > 1:
             async def k():
@@ -23,7 +24,7 @@ async def register_to(plugin):
 
 
     async def stopecho_callback(room, event):
-        global cur_task
+        nonlocal cur_task
         if cur_task is not None:
             await plugin.stop_task(cur_task)
             cur_task = None